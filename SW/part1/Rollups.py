@@ -0,0 +1,110 @@
+# Rollups class
+from typing import List
+
+import bisect
+import json
+import math
+import os
+
+class Rollups:
+    # Supported resolutions, with the length of their buckets in seconds
+    RESOLUTIONS = {"1m": 60, "1h": 60 * 60, "1d": 24 * 60 * 60}
+
+    # Default number of buckets kept for each resolution and series: a week of minutes, a year of hours, ten years of days
+    MAX_BUCKETS = {"1m": 7 * 24 * 60, "1h": 365 * 24, "1d": 10 * 365}
+
+    # Count, min, max and mean of the readings of each series (name and unit), aggregated in time buckets at
+    # several resolutions. The buckets are updated incrementally as the readings are added, and only the most
+    # recent ones are kept, so reading an aggregate never requires going through the raw readings.
+    def __init__(self, maxBuckets: dict = None):
+        self.maxBuckets = maxBuckets if maxBuckets is not None else Rollups.MAX_BUCKETS
+
+        # For each resolution, maps every (name, unit) series to the sorted list of the start times
+        # of its buckets and to the dict of the buckets themselves, as [count, sum, min, max]
+        self.series = {resolution: {} for resolution in Rollups.RESOLUTIONS}
+
+    def add(self, name: str, unit: str, t: float, v: float):
+        for resolution, length in Rollups.RESOLUTIONS.items():
+            series = self.series[resolution].get((name, unit))
+            if series is None:
+                series = self.series[resolution][(name, unit)] = ([], {})
+
+            starts, buckets = series
+            start = math.floor(t / length) * length
+            bucket = buckets.get(start)
+
+            if bucket is None:
+                # Readings usually arrive in order, so this is almost always an append
+                if len(starts) == 0 or start > starts[-1]:
+                    starts.append(start)
+                else:
+                    bisect.insort(starts, start)
+
+                buckets[start] = [1, v, v, v]
+
+                # Drop the oldest bucket if there are too many
+                if len(starts) > self.maxBuckets[resolution]:
+                    buckets.pop(starts.pop(0))
+            else:
+                bucket[0] += 1
+                bucket[1] += v
+                bucket[2] = min(bucket[2], v)
+                bucket[3] = max(bucket[3], v)
+
+    # Writes all the buckets to the specified file, together with nextSeq, the sequence number of the first reading
+    # they don't include, so that the following ones can be added again after a restart
+    def save(self, path: str, nextSeq: int):
+        series = [[resolution, name, unit, [[start] + buckets[start] for start in starts]]
+                  for resolution, resolutionSeries in self.series.items() for (name, unit), (starts, buckets) in resolutionSeries.items()]
+
+        tmpFile = path + ".tmp"
+        with open(tmpFile, "w") as f:
+            json.dump({"nextSeq": nextSeq, "series": series}, f)
+        os.replace(tmpFile, path)
+
+    # Loads the buckets written by save(...) and returns their nextSeq, or None if there's no such file
+    def load(self, path: str) -> int:
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        self.series = {resolution: {} for resolution in Rollups.RESOLUTIONS}
+
+        for resolution, name, unit, buckets in snapshot["series"]:
+            self.series[resolution][(name, unit)] = ([bucket[0] for bucket in buckets], {bucket[0]: bucket[1:] for bucket in buckets})
+
+        return snapshot["nextSeq"]
+
+    # Returns the buckets of the specified resolution starting in [fromT, toT], for every series
+    def query(self, resolution: str, fromT: float = None, toT: float = None) -> List[dict]:
+        rollup = []
+
+        for (name, unit), (starts, buckets) in self.series[resolution].items():
+            lo = 0 if fromT is None else bisect.bisect_left(starts, fromT)
+            hi = len(starts) if toT is None else bisect.bisect_right(starts, toT)
+
+            for start in starts[lo:hi]:
+                count, total, minimum, maximum = buckets[start]
+                rollup.append({"n": name, "u": unit, "t": start, "count": count, "min": minimum, "max": maximum, "mean": total / count})
+
+        return rollup
+
+    # Validates the parameters of a query received via HTTP and converts them to the arguments of query(...)
+    # Raises ValueError if they are not valid.
+    @staticmethod
+    def parseQueryParams(params: dict) -> dict:
+        if "resolution" not in params or params["resolution"] not in Rollups.RESOLUTIONS:
+            raise ValueError("Invalid resolution")
+        if any(p not in ("resolution", "from", "to") for p in params):
+            raise ValueError("Unknown parameter")
+
+        queryArgs = {"resolution": params["resolution"]}
+
+        if "from" in params:
+            queryArgs["fromT"] = float(params["from"])
+        if "to" in params:
+            queryArgs["toT"] = float(params["to"])
+
+        return queryArgs
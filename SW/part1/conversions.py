@@ -1,4 +1,13 @@
-from typing import List
+from typing import List, Tuple
+
+import array
+import sys
+
+# NumPy is only needed for the vectorized batch path: fall back to plain lists if it's missing
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Constants
 CELSIUS_OFFSET = 273.15
@@ -59,19 +68,109 @@ def convert(val: float, originalUnit: str, targetUnit: str) -> float:
 
     return valTarget
 
+# Affine coefficients of every unit, so that a batch needs a single dispatch on the unit pair:
+# valKelvin = scale * (val - shift) + offset   and   valTarget = valKelvin / scale - offset2
+TO_KELVIN = {
+    "K": (0.0, 1.0, 0.0),
+    "C": (0.0, 1.0, CELSIUS_OFFSET),
+    "F": (FAHRENHEIT_CONST_1, FAHRENHEIT_CONST_2, CELSIUS_OFFSET)
+}
+FROM_KELVIN = {
+    "K": (1.0, 0.0),
+    "C": (1.0, CELSIUS_OFFSET),
+    "F": (FAHRENHEIT_CONST_2, FAHRENHEIT_CONST_3)
+}
+
+# Converts a whole batch of temperature values in one step.
+# Returns the converted values and a validity mask: valid[i] is False when vals[i] is below absolute zero
+# (or not a number), in which case targetVals[i] is NaN.
+# With NumPy available both are ndarrays (float64 and bool), otherwise they are plain lists.
+# Raises ValueError (or TypeError) if vals is not a flat sequence of numbers.
+# The same precautions of convert(...) apply here.
+def convertArray(vals, originalUnit: str, targetUnit: str) -> Tuple:
+    shift, scale, offset = TO_KELVIN[originalUnit]
+    targetScale, targetOffset = FROM_KELVIN[targetUnit]
+
+    if numpy is not None:
+        # asarray would turn None into NaN, while float(None) raises TypeError like the list fallback does
+        if isinstance(vals, (list, tuple)) and None in vals:
+            raise TypeError("Values must be numbers")
+
+        vals = numpy.asarray(vals, dtype = numpy.float64)
+
+        # Nested lists would become a matrix, which the list fallback rejects as well
+        if vals.ndim != 1:
+            raise ValueError("Values must be a flat list")
+
+        # Same operations (and rounding) as convert(...), but on the whole array at once
+        valsKelvin = scale * (vals - shift) + offset
+        valid = valsKelvin >= 0
+
+        if originalUnit == targetUnit:
+            valsTarget = vals.copy()
+        else:
+            valsTarget = valsKelvin / targetScale - targetOffset
+        valsTarget[~valid] = numpy.nan
+
+        return valsTarget, valid
+
+    vals = [float(v) for v in vals]
+    valsKelvin = [scale * (v - shift) + offset for v in vals]
+    valid = [k >= 0 for k in valsKelvin]
+
+    if originalUnit == targetUnit:
+        valsTarget = [v if ok else float("nan") for v, ok in zip(vals, valid)]
+    else:
+        valsTarget = [k / targetScale - targetOffset if ok else float("nan") for k, ok in zip(valsKelvin, valid)]
+
+    return valsTarget, valid
+
+# Like convertArray(...), but always returns plain lists, with invalid in place of the invalid values.
+# The lists are built by NumPy, and only the invalid values are patched in Python.
+def convertList(vals, originalUnit: str, targetUnit: str, invalid = None) -> Tuple[list, List[bool]]:
+    valsTarget, valid = convertArray(vals, originalUnit, targetUnit)
+
+    if numpy is not None:
+        invalidPositions = numpy.flatnonzero(~valid).tolist()
+        valsTarget, valid = valsTarget.tolist(), valid.tolist()
+    else:
+        invalidPositions = [i for i, ok in enumerate(valid) if not ok]
+
+    for i in invalidPositions:
+        valsTarget[i] = invalid
+
+    return valsTarget, valid
+
 # Converts a list of temperature values to the desired unit.
 # The same precautions of convert(...) apply here.
 def convertMultiple(vals: List[float], originalUnit: str, targetUnit: str) -> List[float]:
     if originalUnit == targetUnit:
         return vals
 
-    valsTarget = []
+    # If a value is invalid, insert a special string
+    return convertList(vals, originalUnit, targetUnit, "???")[0]
+
+# Converts a packed array of little-endian float64 values, returning the converted values in the same format.
+# The buffer is never parsed element by element: with NumPy it's viewed in place, otherwise it's loaded into an array('d').
+# Physically impossible temperatures are returned as NaN.
+# Raises ValueError if the length of the buffer is not a multiple of 8 bytes.
+def convertPackedFloat64(data, originalUnit: str, targetUnit: str) -> bytes:
+    data = memoryview(data)
+
+    if data.nbytes % 8 != 0:
+        raise ValueError("Buffer length is not a multiple of 8 bytes")
+
+    if numpy is not None:
+        valsTarget, valid = convertArray(numpy.frombuffer(data, dtype = "<f8"), originalUnit, targetUnit)
+        return valsTarget.astype("<f8", copy = False).tobytes()
+
+    vals = array.array("d")
+    vals.frombytes(data)
+    if sys.byteorder == "big":
+        vals.byteswap()
 
-    for v in vals:
-        try:
-            valsTarget.append(convert(v, originalUnit, targetUnit))
-        except ValueError:
-            # If a value is invalid, insert a special string
-            valsTarget.append("???")
+    valsTarget = array.array("d", convertArray(vals, originalUnit, targetUnit)[0])
+    if sys.byteorder == "big":
+        valsTarget.byteswap()
 
-    return valsTarget
\ No newline at end of file
+    return valsTarget.tobytes()
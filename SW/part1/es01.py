@@ -1,18 +1,52 @@
 import cherrypy
+import functools
+import hashlib
 import json
 import conversions
+from Rollups import Rollups
+from SegmentStore import SegmentStore
+from TemperatureLog import TemperatureLog
+from typing import Tuple
 
 class RESTWebService():
     exposed = True
     validUnits = ["C", "K", "F"]
-    listValue = []
+
+    # Maximum number of readings of the temperature log kept in memory, uncompressed and compressed
+    # (about two bytes per reading, so roughly three weeks of 1 Hz readings in a few MBs)
+    logCapacity = 100000
+    logHistoryCapacity = 2000000
+    # Directory where the temperature log is persisted, and number of segments kept there
+    # (raw readings older than that are dropped, their aggregates are kept in the rollups saved there)
+    logDirectory = "temperatureLog"
+    logMaxSegments = 16
+
+    # Maximum number of conversion responses kept in memory
+    cacheSize = 1024
+    # How long (in seconds) clients and intermediaries may reuse a conversion response
+    cacheMaxAge = 86400
+
+    def __init__(self):
+        # Memoize the conversion responses, keyed on the normalized (value, originalUnit, targetUnit) triple
+        self.cachedConversion = functools.lru_cache(maxsize = self.cacheSize)(self.computeConversion)
+
+        # Readings received via POST at /log, persisted to disk. Only the most recent ones are kept in memory
+        self.temperatureLog = TemperatureLog(self.logCapacity, SegmentStore(self.logDirectory, maxSegments = self.logMaxSegments), self.logHistoryCapacity)
 
     def buildJSON(self, originalValue: float, originalUnit: str, targetValue: float, targetUnit: str) -> str:
         retJSON = {"originalValue": originalValue, "originalUnit": originalUnit, "targetValue": targetValue, "targetUnit": targetUnit}
         return json.dumps(retJSON)
 
+    # Performs the conversion and returns the serialized response together with its ETag.
+    # Raises ValueError in case the temperature is physically impossible.
+    def computeConversion(self, originalValue: float, originalUnit: str, targetUnit: str) -> Tuple[str, str]:
+        targetValue = conversions.convert(originalValue, originalUnit, targetUnit)
+        responseJSON = self.buildJSON(originalValue, originalUnit, targetValue, targetUnit)
+
+        return responseJSON, '"' + hashlib.sha1(responseJSON.encode()).hexdigest() + '"'
+
     def GET(self, *uri, **params):
-        if len(uri) != 1:
+        if len(uri) != 1 and uri != ("log", "rollup"):
             # Whathever the uri was, it's not valid
             # Set the appropriate HTTP status
             cherrypy.response.status = 404 # Not Found
@@ -44,19 +78,53 @@ class RESTWebService():
                 cherrypy.response.status = 400 # Bad Request
                 return "Invalid temperature value!"
 
-            # Perform the conversion
+            # Perform the conversion, or reuse the response if it has been computed already
             try:
-                targetValue = conversions.convert(originalValue, originalUnit, targetUnit)
+                responseJSON, etag = self.cachedConversion(originalValue, originalUnit, targetUnit)
             except ValueError as e:
                 cherrypy.response.status = 400 # Bad Request
                 return str(e)
 
-            return self.buildJSON(originalValue, originalUnit, targetValue, targetUnit)
+            # A conversion never changes, so let clients and intermediaries reuse it
+            cherrypy.response.headers["ETag"] = etag
+            cherrypy.response.headers["Cache-Control"] = "public, max-age=" + str(self.cacheMaxAge)
+
+            if etag in cherrypy.request.headers.get("If-None-Match", ""):
+                cherrypy.response.status = 304 # Not Modified
+                return ""
+
+            return responseJSON
+
+        if uri[0] == "converterStats":
+            # Report how well the conversion cache is doing
+            cacheInfo = self.cachedConversion.cache_info()
+            return json.dumps({"hits": cacheInfo.hits, "misses": cacheInfo.misses, "size": cacheInfo.currsize, "maxSize": cacheInfo.maxsize})
         
+        if uri == ("log", "rollup"):
+            # Aggregates of the temperature data, at the requested resolution
+            try:
+                queryArgs = Rollups.parseQueryParams(params)
+            except ValueError:
+                cherrypy.response.status = 400 # Bad Request
+                return "Wrong parameters!<br>Usage: log/rollup?resolution=&lt;1m, 1h or 1d&gt;&from=&lt;time&gt;&to=&lt;time&gt;, from and to are optional."
+
+            return json.dumps(self.temperatureLog.rollup(**queryArgs))
+
         if uri[0] == "log":
-            # Log all the temperature data received so far
-            return json.dumps(self.listValue) # Use json.dumps to print the list instead of just converting
-                                              # it into a string to print with the double quotes to be compliant with JSON
+            if len(params) == 0:
+                # Log all the temperature data received so far
+                return json.dumps(self.temperatureLog.toSenML()) # Use json.dumps to print the list instead of just converting
+                                                                 # it into a string to print with the double quotes to be compliant with JSON
+
+            # Only log the requested page of data
+            try:
+                queryArgs = TemperatureLog.parseQueryParams(params)
+            except ValueError:
+                cherrypy.response.status = 400 # Bad Request
+                return "Wrong parameters!<br>Usage: log?from=&lt;time&gt;&to=&lt;time&gt;&limit=&lt;max readings&gt;&cursor=&lt;nextCursor of the previous page&gt;, all optional."
+
+            readings, nextCursor = self.temperatureLog.query(**queryArgs)
+            return json.dumps({"log": readings, "nextCursor": nextCursor})
 
         # The command is not valid
         cherrypy.response.status = 404 # Not Found
@@ -66,17 +134,26 @@ class RESTWebService():
         # Check if the uri is valid
         if len(uri) == 1 and uri[0] == "log":
             body = cherrypy.request.body.read()
-            val = json.loads(body)
 
-            # Check if the received JSON is correct
-            if ("bn" not in val or val["bn"] != "Yun" or "e" not in val
-                    or "n" not in val["e"][0] or val ["e"][0]["n"] != "temperature"
-                    or "t" not in val["e"][0] or "v" not in val["e"][0] or "u" not in val["e"][0]):
+            # Check if the received JSON is a correct SenML pack, with any number of records
+            try:
+                readings = TemperatureLog.parseSenML(json.loads(body))
+            except ValueError:
                 # The body is not what we expected -> reject it
                 cherrypy.response.status = 400 # Bad Request
                 return
 
-            self.listValue.append(val)
+            # Only temperature readings from the Yun are accepted
+            if any(baseName != "Yun" or name != "temperature" for baseName, name, _, _, _ in readings):
+                cherrypy.response.status = 400 # Bad Request
+                return
+
+            # Store all the readings at once
+            try:
+                self.temperatureLog.appendMany(readings)
+            except (TypeError, ValueError):
+                cherrypy.response.status = 400 # Bad Request
+                return
 
 if __name__ == "__main__":
     conf = {
@@ -1,11 +1,26 @@
 import cherrypy
 import json
 import conversions
+from Rollups import Rollups
+from SegmentStore import SegmentStore
+from TemperatureLog import TemperatureLog
 
 class RESTWebService():
     exposed = True
     validUnits = ["C", "K", "F"]
-    listValue = []
+
+    # Maximum number of readings of the temperature log kept in memory, uncompressed and compressed
+    # (about two bytes per reading, so roughly three weeks of 1 Hz readings in a few MBs)
+    logCapacity = 100000
+    logHistoryCapacity = 2000000
+    # Directory where the temperature log is persisted, and number of segments kept there
+    # (raw readings older than that are dropped, their aggregates are kept in the rollups saved there)
+    logDirectory = "temperatureLog"
+    logMaxSegments = 16
+
+    def __init__(self):
+        # Readings received via POST at /log, persisted to disk. Only the most recent ones are kept in memory
+        self.temperatureLog = TemperatureLog(self.logCapacity, SegmentStore(self.logDirectory, maxSegments = self.logMaxSegments), self.logHistoryCapacity)
 
     def buildJSON(self, originalValue: float, originalUnit: str, targetValue: float, targetUnit: str) -> str:
         retJSON = {"originalValue": originalValue, "originalUnit": originalUnit, "targetValue": targetValue, "targetUnit": targetUnit}
@@ -53,10 +68,31 @@ class RESTWebService():
 
             return self.buildJSON(originalValue, originalUnit, targetValue, targetUnit)
 
+        if uri == ("log", "rollup"):
+            # Aggregates of the temperature data, at the requested resolution
+            try:
+                queryArgs = Rollups.parseQueryParams(params)
+            except ValueError:
+                cherrypy.response.status = 400 # Bad Request
+                return "Wrong parameters!<br>Usage: log/rollup?resolution=&lt;1m, 1h or 1d&gt;&from=&lt;time&gt;&to=&lt;time&gt;, from and to are optional."
+
+            return json.dumps(self.temperatureLog.rollup(**queryArgs))
+
         if uri[0] == "log":
-            # Log all the temperature data received so far
-            return json.dumps(self.listValue) # Use json.dumps to print the list instead of just converting
-                                              # it into a string to print with the double quotes to be compliant with JSON
+            if len(params) == 0:
+                # Log all the temperature data received so far
+                return json.dumps(self.temperatureLog.toSenML()) # Use json.dumps to print the list instead of just converting
+                                                                 # it into a string to print with the double quotes to be compliant with JSON
+
+            # Only log the requested page of data
+            try:
+                queryArgs = TemperatureLog.parseQueryParams(params)
+            except ValueError:
+                cherrypy.response.status = 400 # Bad Request
+                return "Wrong parameters!<br>Usage: log?from=&lt;time&gt;&to=&lt;time&gt;&limit=&lt;max readings&gt;&cursor=&lt;nextCursor of the previous page&gt;, all optional."
+
+            readings, nextCursor = self.temperatureLog.query(**queryArgs)
+            return json.dumps({"log": readings, "nextCursor": nextCursor})
 
         # The command is not valid
         cherrypy.response.status = 404 # Not Found
@@ -66,17 +102,26 @@ class RESTWebService():
         # Check if the uri is valid
         if len(uri) == 1 and uri[0] == "log":
             body = cherrypy.request.body.read()
-            val = json.loads(body)
 
-            # Check if the received JSON is correct
-            if ("bn" not in val or val["bn"] != "Yun" or "e" not in val
-                    or "n" not in val["e"][0] or val ["e"][0]["n"] != "temperature"
-                    or "t" not in val["e"][0] or "v" not in val["e"][0] or "u" not in val["e"][0]):
+            # Check if the received JSON is a correct SenML pack, with any number of records
+            try:
+                readings = TemperatureLog.parseSenML(json.loads(body))
+            except ValueError:
                 # The body is not what we expected -> reject it
                 cherrypy.response.status = 400 # Bad Request
                 return
 
-            self.listValue.append(val)
+            # Only temperature readings from the Yun are accepted
+            if any(baseName != "Yun" or name != "temperature" for baseName, name, _, _, _ in readings):
+                cherrypy.response.status = 400 # Bad Request
+                return
+
+            # Store all the readings at once
+            try:
+                self.temperatureLog.appendMany(readings)
+            except (TypeError, ValueError):
+                cherrypy.response.status = 400 # Bad Request
+                return
 
 if __name__ == "__main__":
     conf = {
@@ -6,6 +6,9 @@ class RESTWebService():
     exposed = True
     validUnits = ["C", "K", "F"]
 
+    # Number of values converted at once when streaming
+    streamBatchSize = 4096
+
     def GET(self, *uri, **params):
         # Shutdown on "shutdown". Used for debugging purposes
         if len(uri) == 1 and uri[0] == "shutdown":
@@ -18,6 +21,14 @@ class RESTWebService():
         if len(uri) != 1 or uri[0] != "converter":
             return "Please choose a valid command!<br>Only 'converter' is implemented for now."
 
+        # Packed float64 values are converted straight from the raw body, without going through JSON
+        if cherrypy.request.headers.get("Content-Type", "").startswith("application/octet-stream"):
+            return self.convertBinary(**params)
+
+        # Newline-delimited JSON values are converted incrementally and streamed back
+        if cherrypy.request.headers.get("Content-Type", "").startswith("application/x-ndjson"):
+            return self.convertStream(**params)
+
         # Get the body
         body = cherrypy.request.body.read().decode()
 
@@ -39,23 +50,98 @@ class RESTWebService():
         if originalUnit not in self.validUnits or targetUnit not in self.validUnits:
             return "Invalid temperature units!"
 
-        # Check if the values are numerical
-        originalValues = data["values"]
+        # Perform the conversion of the whole batch at once
+        # This also checks that the values are numerical
+        if not isinstance(data["values"], list):
+            return "Invalid temperature values!"
 
+        # Physically impossible temperatures are reported as null, with the validity mask telling them apart
         try:
-            for v in originalValues:
-                int(v)
-        except:
+            targetValues, valid = conversions.convertList(data["values"], originalUnit, targetUnit)
+        except (TypeError, ValueError):
             return "Invalid temperature values!"
 
-        # Perform the conversion
-        targetValues = conversions.convertMultiple(originalValues, originalUnit, targetUnit)
-
         # Create a new dict to have the desired order of the key-value pairs
-        dataUpdated = {"values": data["values"], "originalUnit": originalUnit, "targetValues": targetValues, "targetUnit": targetUnit}
+        dataUpdated = {"values": data["values"], "originalUnit": originalUnit, "targetValues": targetValues, "targetUnit": targetUnit, "valid": valid}
 
         return json.dumps(dataUpdated)
 
+    # Converts a body of packed little-endian float64 values, with the units passed as parameters:
+    # converter?originalUnit=<orig>&targetUnit=<trgt>. The response body has the same format.
+    def convertBinary(self, **params):
+        if len(params) != 2 or "originalUnit" not in params or "targetUnit" not in params:
+            cherrypy.response.status = 400 # Bad Request
+            return "Wrong parameters!<br>Usage: converter?originalUnit=&lt;orig&gt;&targetUnit=&lt;trgt&gt;."
+
+        originalUnit = params["originalUnit"].upper()
+        targetUnit = params["targetUnit"].upper()
+
+        # Check if the units are valid
+        if originalUnit not in self.validUnits or targetUnit not in self.validUnits:
+            cherrypy.response.status = 400 # Bad Request
+            return "Invalid temperature units!"
+
+        try:
+            targetValues = conversions.convertPackedFloat64(cherrypy.request.body.read(), originalUnit, targetUnit)
+        except ValueError as e:
+            cherrypy.response.status = 400 # Bad Request
+            return str(e)
+
+        cherrypy.response.headers["Content-Type"] = "application/octet-stream"
+        return targetValues
+
+    # Converts a body of newline-delimited JSON values (possibly sent with chunked transfer encoding),
+    # with the units passed as parameters: converter?originalUnit=<orig>&targetUnit=<trgt>.
+    # Every non-empty line of the body gets a line in the response, holding the converted value or
+    # null if the line was not a number or the temperature is physically impossible.
+    def convertStream(self, **params):
+        if len(params) != 2 or "originalUnit" not in params or "targetUnit" not in params:
+            cherrypy.response.status = 400 # Bad Request
+            return "Wrong parameters!<br>Usage: converter?originalUnit=&lt;orig&gt;&targetUnit=&lt;trgt&gt;."
+
+        originalUnit = params["originalUnit"].upper()
+        targetUnit = params["targetUnit"].upper()
+
+        # Check if the units are valid
+        if originalUnit not in self.validUnits or targetUnit not in self.validUnits:
+            cherrypy.response.status = 400 # Bad Request
+            return "Invalid temperature units!"
+
+        # Stream the response: the body is read and converted while the response is being sent,
+        # so only one batch of values is ever held in memory
+        cherrypy.response.headers["Content-Type"] = "application/x-ndjson"
+        cherrypy.response.stream = True
+
+        return self.streamConversion(cherrypy.request.body, originalUnit, targetUnit)
+
+    # Generator reading the lines of the body and yielding the converted values batch by batch
+    def streamConversion(self, lines, originalUnit: str, targetUnit: str):
+        batch = []
+
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                batch.append(float(json.loads(line)))
+            except (TypeError, ValueError):
+                # Not a number -> it will be reported as null
+                batch.append(float("nan"))
+
+            if len(batch) == self.streamBatchSize:
+                yield self.serializeStreamBatch(batch, originalUnit, targetUnit)
+                batch = []
+
+        if batch:
+            yield self.serializeStreamBatch(batch, originalUnit, targetUnit)
+
+    def serializeStreamBatch(self, batch: list, originalUnit: str, targetUnit: str) -> bytes:
+        # Invalid values are None, i.e. null
+        targetValues = conversions.convertList(batch, originalUnit, targetUnit)[0]
+
+        return "".join(json.dumps(v) + "\n" for v in targetValues).encode()
+
 if __name__ == "__main__":
     conf = {
         "/": {
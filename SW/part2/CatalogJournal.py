@@ -0,0 +1,179 @@
+# CatalogJournal class
+from typing import List, Tuple
+
+import cherrypy
+import contextlib
+import json
+import os
+import threading
+import time
+
+class CatalogJournal:
+    # Append-only journal of the changes to the catalog, one JSON record per line:
+    #   {"op": "upsert", "collection": "devices", "entity": {...}}
+    #   {"op": "remove", "collection": "devices", "id": "..."}
+    # so that each change costs O(record) instead of rewriting the whole catalog.
+    # The journal is periodically compacted into a snapshot of the whole catalog, after which it starts over.
+    # Records are only buffered in memory by the request handlers: a CatalogPersister thread writes them to disk,
+    # so that the handlers never wait for the disk and many changes are committed with a single write.
+    def __init__(self, snapshotFile: str, journalFile: str, maxJournalSize: int = 4 * 1024 * 1024, maxJournalAge: float = 10 * 60):
+        self.snapshotFile = snapshotFile
+        self.journalFile = journalFile
+        self.maxJournalSize = maxJournalSize
+        self.maxJournalAge = maxJournalAge
+
+        self.journal = None
+        self.journalSize = 0
+        self.journalCreationTime = time.monotonic()
+
+        # Records not written to disk yet. Only the last one of each entity is needed, so they're coalesced
+        self.pending = {}
+
+        # Protects the pending records. Held only for in-memory work, as the store appends while holding its own locks
+        self.lock = threading.Lock()
+
+        # Flushes and compactions must not interleave. The disk is written and synced only while holding this one
+        self.ioLock = threading.Lock()
+
+    # Reads the snapshot (None if there's none) and the records of the journal written after it
+    def load(self) -> Tuple[dict, List[dict]]:
+        snapshot = None
+        records = []
+
+        try:
+            with open(self.snapshotFile) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        try:
+            with open(self.journalFile) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Partially written record (e.g. after a crash): it's the last one anyway
+                        break
+        except OSError:
+            pass
+
+        return snapshot, records
+
+    # entityJSON is the already serialized entity, which is embedded as it is
+    def upsert(self, collection: str, entityID: str, entityJSON: str):
+        self.append(collection, entityID, '{"op": "upsert", "collection": ' + json.dumps(collection) + ', "entity": ' + entityJSON + "}\n")
+
+    def remove(self, collection: str, entityID: str):
+        self.append(collection, entityID, json.dumps({"op": "remove", "collection": collection, "id": entityID}) + "\n")
+
+    def append(self, collection: str, entityID: str, line: str):
+        with self.lock:
+            # Replace the previous record of the same entity, and move it to the end
+            self.pending.pop((collection, entityID), None)
+            self.pending[(collection, entityID)] = line
+
+    # Takes all the pending records, which are then written by the caller
+    def takePending(self) -> dict:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        return pending
+
+    # Puts back the records that couldn't be written, unless the same entities changed again in the meantime
+    def restorePending(self, pending: dict):
+        with self.lock:
+            for key, line in pending.items():
+                self.pending.setdefault(key, line)
+
+    # Writes all the pending records with a single write, and waits for them to be on disk.
+    # Appends are not blocked in the meantime: the new records are written with the next flush.
+    def flush(self):
+        with self.ioLock:
+            pending = self.takePending()
+            if len(pending) == 0:
+                return
+
+            data = "".join(pending.values())
+
+            try:
+                if self.journal is None:
+                    self.journal = open(self.journalFile, "a")
+
+                self.journal.write(data)
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+            except OSError:
+                # Keep the records, they'll be written with the next flush
+                print("ERROR: Couldn't write the journal " + self.journalFile)
+                self.restorePending(pending)
+                return
+
+            self.journalSize += len(data)
+
+    # Whether the journal is big or old enough to be compacted
+    def needsCompaction(self) -> bool:
+        return self.journalSize >= self.maxJournalSize or (self.journalSize > 0 and time.monotonic() - self.journalCreationTime >= self.maxJournalAge)
+
+    # Writes a snapshot of the catalog and empties the journal.
+    # captureSnapshot() is called while the changes are blocked by blockChanges(), which must also block the appends,
+    # and returns a function returning the JSON snapshot. The pending records are in the snapshot, so they're dropped
+    # at the same time, while the records appended later stay pending until the new journal is started.
+    # The snapshot is serialized and written without blocking anything, to a temporary file first and then renamed,
+    # so that a crash never leaves a truncated snapshot behind.
+    def compact(self, captureSnapshot, blockChanges = contextlib.nullcontext):
+        with self.ioLock:
+            with blockChanges():
+                serializeSnapshot = captureSnapshot()
+                pending = self.takePending()
+
+            tmpFile = self.snapshotFile + ".tmp"
+
+            try:
+                with open(tmpFile, "w") as f:
+                    f.write(serializeSnapshot())
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmpFile, self.snapshotFile)
+            except (OSError, TypeError, ValueError):
+                print("ERROR: Couldn't write the snapshot " + self.snapshotFile)
+                # The records are not in any snapshot on disk, they still have to go to the journal
+                self.restorePending(pending)
+                return
+
+            # Everything written so far is in the snapshot now: start a new journal
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = open(self.journalFile, "w")
+            self.journalSize = 0
+            self.journalCreationTime = time.monotonic()
+
+# Thread that writes the journal of the catalog to disk at most once every flushInterval seconds, and compacts it
+# (by calling compact()) when needed. It is also a cherrypy plugin, to flush everything when cherrypy stops.
+class CatalogPersister(threading.Thread, cherrypy.process.plugins.SimplePlugin):
+    def __init__(self, bus, journal: CatalogJournal, compact, flushInterval: float):
+        threading.Thread.__init__(self)
+        cherrypy.process.plugins.SimplePlugin.__init__(self, bus)
+
+        self.journal = journal
+        self.compact = compact
+        self.flushInterval = flushInterval
+
+        self.running = True
+
+        # Used to wake the thread up when it's time to shutdown
+        self.wakeEvent = threading.Event()
+
+    def run(self):
+        while self.running:
+            self.wakeEvent.wait(timeout = self.flushInterval)
+
+            # Everything changed since the last time is written at once
+            self.journal.flush()
+
+            if self.journal.needsCompaction():
+                self.compact()
+
+    # To be called when cherrypy stops to stop the thread, after the last flush
+    def stop(self):
+        self.running = False
+        self.wakeEvent.set()
@@ -0,0 +1,357 @@
+# CatalogStore class
+from CatalogJournal import CatalogJournal
+from typing import List, Tuple
+
+import bisect
+import collections
+import contextlib
+import json
+import threading
+import time
+
+class CatalogStore:
+    COLLECTIONS = ("devices", "services", "users")
+
+    # Thread-safe store of the devices, services and users of the catalog.
+    # Each collection has its own lock, held by writers only. Readers get immutable snapshots (tuples of entities),
+    # built at most once after each change, so they never block on or race with writers such as the expiry sweep.
+    # Entities must not be modified once they're in the store: an update replaces the entity with a new one.
+    # The only exception is the timestamp, which is updated by touch().
+    # This way each entity is serialized to JSON only once, when it's added, and lists are built by joining
+    # the JSON fragments of the entities (once per change, too) instead of encoding everything for every request.
+    # The JSON of each entity is also kept without the timestamp, so that touch() can rebuild it by just appending the new one.
+    # Devices and services are also indexed by the keys returned by their indexKeys() (e.g. ("resource", "temperature")),
+    # so that find() returns the entities, and the end points, matching some keys in O(matches).
+    # Every change is recorded in the journal, if one is specified.
+    # Every change also gets a version number, and the last maxChanges ones are kept in a change log, so that clients
+    # can ask for what changed since a version. Refreshing the timestamp with touch() is not a change.
+    def __init__(self, journal: CatalogJournal = None, maxChanges: int = 10000):
+        self.journal = journal
+        self.maxChanges = maxChanges
+
+        self.entities      = {collection: {} for collection in CatalogStore.COLLECTIONS}
+        self.fragments     = {collection: {} for collection in CatalogStore.COLLECTIONS}
+        self.prefixes      = {collection: {} for collection in CatalogStore.COLLECTIONS}
+        self.locks         = {collection: threading.RLock() for collection in CatalogStore.COLLECTIONS}
+        self.snapshots     = {collection: None for collection in CatalogStore.COLLECTIONS}
+        self.snapshotJSONs = {collection: None for collection in CatalogStore.COLLECTIONS}
+
+        # For each collection, maps every index key to a dict of the entities with that key, each one with the positions
+        # of its matching end points: an int if there's only one (as usual), a tuple otherwise, None if the key is not
+        # about an end point. Sets would cost more than the entity itself, for every key of every entity
+        self.indexes = {collection: {} for collection in CatalogStore.COLLECTIONS}
+
+        # Sorted IDs of each collection, to page through it. Built on the first request
+        self.sortedIDs = {collection: None for collection in CatalogStore.COLLECTIONS}
+
+        # Versions start from the current time in microseconds instead of 0, so that they keep increasing across restarts
+        self.version = time.time_ns() // 1000
+        self.collectionVersions = {collection: self.version for collection in CatalogStore.COLLECTIONS}
+
+        # (version, collection, entityID) of the last changes. The ones up to version changesFloor have been dropped
+        self.changes = collections.deque()
+        self.changesFloor = self.version
+        self.changesLock = threading.Lock()
+
+        # Notified at every change, to wake up the clients waiting for one
+        self.changed = threading.Condition(self.changesLock)
+
+    # Returns the entity with the specified ID, or None
+    def get(self, collection: str, entityID: str):
+        return self.entities[collection].get(entityID)
+
+    # Returns the JSON of the entity with the specified ID, or None
+    def getJSON(self, collection: str, entityID: str) -> str:
+        return self.fragments[collection].get(entityID)
+
+    # Returns an immutable snapshot of the entities of the collection
+    def snapshot(self, collection: str) -> tuple:
+        snapshot = self.snapshots[collection]
+
+        if snapshot is None:
+            with self.locks[collection]:
+                snapshot = self.snapshots[collection]
+
+                if snapshot is None:
+                    snapshot = self.snapshots[collection] = tuple(self.entities[collection].values())
+
+        return snapshot
+
+    # Returns the (entity, positions) pairs of the entities with all the specified index keys, together with the
+    # positions of their end points that match all of them (None if the keys don't restrict the end points).
+    # If entityID is specified, only that entity is considered.
+    def find(self, collection: str, keys: list, entityID: str = None) -> List[tuple]:
+        with self.locks[collection]:
+            postings = [self.indexes[collection].get(key, {}) for key in keys]
+
+            if entityID is not None:
+                candidates = [entityID] if entityID in self.entities[collection] else []
+            elif len(postings) > 0:
+                candidates = min(postings, key = len)
+            else:
+                candidates = self.entities[collection]
+
+            matches = []
+
+            for candidate in candidates:
+                if not all(candidate in posting for posting in postings):
+                    continue
+
+                positions = None
+                for posting in postings:
+                    keyPositions = posting[candidate]
+
+                    if keyPositions is not None:
+                        keyPositions = {keyPositions} if isinstance(keyPositions, int) else set(keyPositions)
+                        positions = keyPositions if positions is None else positions & keyPositions
+
+                # The keys are about different end points
+                if positions is not None and len(positions) == 0:
+                    continue
+
+                matches.append((self.entities[collection][candidate], positions))
+
+            return matches
+
+    # Adds (or removes) the entity to the indexes of the collection
+    def index(self, collection: str, entityID: str, entity, add: bool):
+        if not hasattr(entity, "indexKeys"):
+            return
+
+        index = self.indexes[collection]
+        positions = {}
+
+        for key, position in entity.indexKeys():
+            if position is None:
+                positions[key] = None
+            elif key not in positions:
+                positions[key] = {position}
+            elif positions[key] is not None:
+                positions[key].add(position)
+
+        for key, keyPositions in positions.items():
+            if add:
+                if keyPositions is not None:
+                    keyPositions = keyPositions.pop() if len(keyPositions) == 1 else tuple(sorted(keyPositions))
+
+                index.setdefault(key, {})[entityID] = keyPositions
+            else:
+                index[key].pop(entityID, None)
+
+                if len(index[key]) == 0:
+                    del index[key]
+
+    # Returns the (entity, JSON) pairs of at most limit entities with an ID greater than cursor, in ID order,
+    # together with the cursor of the next page (None if this is the last one)
+    def page(self, collection: str, cursor: str = None, limit: int = None) -> Tuple[List[tuple], str]:
+        with self.locks[collection]:
+            sortedIDs = self.sortedIDs[collection]
+            if sortedIDs is None:
+                sortedIDs = self.sortedIDs[collection] = sorted(self.entities[collection])
+
+            start = 0 if cursor is None else bisect.bisect_right(sortedIDs, cursor)
+            end = len(sortedIDs) if limit is None else min(start + limit, len(sortedIDs))
+
+            page = [(self.entities[collection][entityID], self.fragments[collection][entityID]) for entityID in sortedIDs[start:end]]
+
+            return page, (sortedIDs[end - 1] if start < end < len(sortedIDs) else None)
+
+    # Returns the JSON list of the entities of the collection
+    def snapshotJSON(self, collection: str) -> str:
+        snapshotJSON = self.snapshotJSONs[collection]
+
+        if snapshotJSON is None:
+            with self.locks[collection]:
+                snapshotJSON = self.snapshotJSONs[collection]
+
+                if snapshotJSON is None:
+                    snapshotJSON = self.snapshotJSONs[collection] = "[" + ", ".join(self.fragments[collection].values()) + "]"
+
+        return snapshotJSON
+
+    # Returns a function that returns the JSON object of all the collections as they are now, each one mapping
+    # the IDs to the entities, plus the specified fields. Only the JSON fragments are copied while holding the locks:
+    # the JSON itself is built by the function, without blocking any change
+    def captureJSON(self, fields: dict = {}):
+        with self.lockAll():
+            fragments = [(collection, self.fragments[collection].copy()) for collection in CatalogStore.COLLECTIONS]
+
+        fieldMembers = [json.dumps(name) + ": " + json.dumps(value) for name, value in fields.items()]
+
+        def serialize() -> str:
+            members = list(fieldMembers)
+
+            for collection, collectionFragments in fragments:
+                entities = ", ".join(json.dumps(entityID) + ": " + fragment for entityID, fragment in collectionFragments.items())
+                members.append(json.dumps(collection) + ": {" + entities + "}")
+
+            return "{" + ", ".join(members) + "}"
+
+        return serialize
+
+    # Context manager that blocks all the changes, e.g. to take a consistent snapshot.
+    # The locks are always taken in the same order, and before the lock of the journal.
+    @contextlib.contextmanager
+    def lockAll(self):
+        with contextlib.ExitStack() as stack:
+            for collection in CatalogStore.COLLECTIONS:
+                stack.enter_context(self.locks[collection])
+
+            yield
+
+    # Returns the JSON of the entity without the timestamp, and the complete JSON
+    @staticmethod
+    def serializeEntity(entity) -> tuple:
+        entityDesc = entity.serialize()
+        timestamp = entityDesc.pop("timestamp", None)
+        prefix = json.dumps(entityDesc)
+
+        return prefix, CatalogStore.appendTimestamp(prefix, timestamp)
+
+    @staticmethod
+    def appendTimestamp(prefix: str, timestamp: str) -> str:
+        if timestamp is None:
+            return prefix
+
+        return prefix[:-1] + ', "timestamp": ' + json.dumps(timestamp) + "}"
+
+    # Returns the current version and the (collection, entityID, JSON) of the entities changed after version since,
+    # in the order they changed. The JSON is None for the removed entities.
+    # Raises ValueError if since is not a valid version, or if it is too old to be in the change log.
+    def changesSince(self, since: int) -> Tuple[int, List[tuple]]:
+        with self.changesLock:
+            if since < self.changesFloor or since > self.version:
+                raise ValueError("Unknown version")
+
+            version = self.version
+            changed = {}
+
+            for changeVersion, collection, entityID in reversed(self.changes):
+                if changeVersion <= since:
+                    break
+
+                changed.setdefault((collection, entityID), None)
+
+        # The entities may have changed again in the meantime: that's fine, as they'll be reported again next time
+        return version, [(collection, entityID, self.fragments[collection].get(entityID)) for collection, entityID in reversed(list(changed))]
+
+    # Waits until the catalog changes after version since, for at most timeout seconds. Returns whether it did
+    def waitForChange(self, since: int, timeout: float) -> bool:
+        with self.changed:
+            return self.changed.wait_for(lambda: self.version > since, timeout)
+
+    # Marks the collection as changed. The lock of the collection must be held
+    def invalidate(self, collection: str):
+        self.snapshots[collection] = None
+        self.snapshotJSONs[collection] = None
+
+    # Gives a new version to a change of an entity. The lock of the collection must be held
+    def recordChange(self, collection: str, entityID: str):
+        with self.changesLock:
+            self.version += 1
+            self.collectionVersions[collection] = self.version
+            self.changes.append((self.version, collection, entityID))
+
+            if len(self.changes) > self.maxChanges:
+                self.changesFloor = self.changes.popleft()[0]
+
+            self.changed.notify_all()
+
+    # Adds or replaces an entity. Returns the entity in the store, see upsertMany(...)
+    def upsert(self, collection: str, entityID: str, entity):
+        return self.upsertMany(collection, [(entityID, entity)])[0]
+
+    # Adds or replaces many entities, given as (entityID, entity) pairs, all at once.
+    # An entity equal to the one in the store but for the timestamp is not replaced: the stored one is touched instead,
+    # so that periodic registrations are not changes. Returns the entities in the store, in the same order.
+    def upsertMany(self, collection: str, entities: List[tuple]) -> List:
+        serialized = [(entityID, entity) + CatalogStore.serializeEntity(entity) for entityID, entity in entities]
+        stored = []
+
+        with self.locks[collection]:
+            changed = False
+
+            for entityID, entity, prefix, fragment in serialized:
+                previous = self.entities[collection].get(entityID)
+
+                if previous is not None and self.prefixes[collection][entityID] == prefix:
+                    stored.append(self.touchLocked(collection, entityID, getattr(entity, "timestamp", None)))
+                    continue
+
+                stored.append(entity)
+                changed = True
+
+                if previous is not None:
+                    self.index(collection, entityID, previous, False)
+                elif self.sortedIDs[collection] is not None:
+                    bisect.insort(self.sortedIDs[collection], entityID)
+                self.index(collection, entityID, entity, True)
+
+                self.entities[collection][entityID] = entity
+                self.fragments[collection][entityID] = fragment
+                self.prefixes[collection][entityID] = prefix
+                self.recordChange(collection, entityID)
+
+                if self.journal is not None:
+                    self.journal.upsert(collection, entityID, fragment)
+
+            if changed:
+                self.invalidate(collection)
+
+        return stored
+
+    # Updates the timestamp of an entity, without serializing it again.
+    # Returns the entity, or None if there's no such entity.
+    def touch(self, collection: str, entityID: str, timestamp: str):
+        with self.locks[collection]:
+            if entityID not in self.entities[collection]:
+                return None
+
+            return self.touchLocked(collection, entityID, timestamp)
+
+    # The lock of the collection must be held, and the entity must exist
+    def touchLocked(self, collection: str, entityID: str, timestamp: str):
+        entity = self.entities[collection][entityID]
+
+        # Entities without a timestamp have nothing to refresh
+        if timestamp is None:
+            return entity
+
+        entity.timestamp = timestamp
+        fragment = self.fragments[collection][entityID] = CatalogStore.appendTimestamp(self.prefixes[collection][entityID], timestamp)
+
+        # The snapshot holds the same entities, only the JSON list changes
+        self.snapshotJSONs[collection] = None
+
+        if self.journal is not None:
+            self.journal.upsert(collection, entityID, fragment)
+
+        return entity
+
+    # Removes an entity, only if it is still the expected one with the expected timestamp (when specified).
+    # Returns the removed entity, or None.
+    def remove(self, collection: str, entityID: str, expected = None, timestamp: str = None):
+        with self.locks[collection]:
+            entity = self.entities[collection].get(entityID)
+
+            if entity is None or (expected is not None and entity is not expected):
+                return None
+            if timestamp is not None and getattr(entity, "timestamp", None) != timestamp:
+                return None
+
+            self.index(collection, entityID, entity, False)
+
+            if self.sortedIDs[collection] is not None:
+                sortedIDs = self.sortedIDs[collection]
+                del sortedIDs[bisect.bisect_left(sortedIDs, entityID)]
+
+            del self.entities[collection][entityID]
+            del self.fragments[collection][entityID]
+            del self.prefixes[collection][entityID]
+            self.invalidate(collection)
+            self.recordChange(collection, entityID)
+
+            if self.journal is not None:
+                self.journal.remove(collection, entityID)
+
+            return entity
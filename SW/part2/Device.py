@@ -1,14 +1,34 @@
 # Device class
 from EndPoint import EndPoint
+
+import sys
  
 class Device:
-    def __init__(self, deviceID, availableResources):
+    # No per-instance dict, as the catalog may hold millions of devices
+    __slots__ = ("deviceID", "endPoints", "availableResources", "timestamp")
+
+    # End points and resources are stored as tuples, and resource names (e.g. "temperature") are interned,
+    # since the same few ones are used by most devices
+    def __init__(self, deviceID, availableResources, endPoints: tuple = ()):
         self.deviceID = deviceID
-        self.endPoints = list()
-        self.availableResources = availableResources
+        self.endPoints = tuple(endPoints)
+        self.availableResources = tuple(sys.intern(r) for r in availableResources)
+        self.timestamp = None
  
     def addEndPoint(self, endPoint: EndPoint):
-        self.endPoints.append(endPoint)
+        self.endPoints += (endPoint,)
+
+    # Keys of the indexes of the catalog this device can be found with, each one with the position of the matching end point.
+    # Resources and end points are matched by position, if there are as many of them; otherwise the position is None
+    def indexKeys(self):
+        for i, e in enumerate(self.endPoints):
+            for key in e.indexKeys():
+                yield key, i
+
+        parallel = len(self.availableResources) == len(self.endPoints)
+
+        for i, r in enumerate(self.availableResources):
+            yield ("resource", r), (i if parallel else None)
 
     def serialize(self) -> dict:
         # Serializes the current Device object and returns a dict representing the same entity
@@ -25,14 +45,18 @@ class Device:
         if "deviceID" not in deviceDesc or "endPoints" not in deviceDesc or "resources" not in deviceDesc:
             raise ValueError("JSON doesn't contain necessary params")
 
-        d = Device(deviceDesc["deviceID"], deviceDesc["resources"])
+        # IDs are used in URLs and to sort the catalog
+        if not isinstance(deviceDesc["deviceID"], str):
+            raise ValueError("deviceID must be a string")
 
-        # Now add the endpoints
-        for endPointDesc in deviceDesc["endPoints"]:
-            try:
-                d.addEndPoint(EndPoint.parseEndPoint(endPointDesc))
-            except:
-                # Raise another exception with proper description
-                raise ValueError("End point is not valid")
-        
-        return d
\ No newline at end of file
+        if not isinstance(deviceDesc["resources"], list) or not all(isinstance(r, str) for r in deviceDesc["resources"]):
+            raise ValueError("Resources must be a list of strings")
+
+        # Parse the endpoints
+        try:
+            endPoints = tuple(EndPoint.parseEndPoint(endPointDesc) for endPointDesc in deviceDesc["endPoints"])
+        except:
+            # Raise another exception with proper description
+            raise ValueError("End point is not valid")
+
+        return Device(deviceDesc["deviceID"], deviceDesc["resources"], endPoints)
\ No newline at end of file
@@ -1,4 +1,5 @@
 # EndPoint class
+import sys
 
 class EndPoint:
     TYPE_WEB_SERVICE    = "webService"
@@ -10,17 +11,48 @@ class EndPoint:
     # Whether the service is used to pass data/commands to the device/web service or to get data/information
     WEB_TYPE_PRODUCER   = "producer" # Use the service to get data
     WEB_TYPE_CONSUMER   = "consumer" # Use the service to give commands
-    
-    def __init__(self, service: str, endPointType: bool):
+
+    # Valid roles for each type, and the json field they're stored into
+    ROLES = {
+        TYPE_MQTT_TOPIC:  ("mqttClientType", (MQTT_PUBLISHER, MQTT_SUBSCRIBER)),
+        TYPE_WEB_SERVICE: ("webType", (WEB_TYPE_PRODUCER, WEB_TYPE_CONSUMER))
+    }
+
+    # The catalog may hold millions of end points: no per-instance dict, and the type and role are interned
+    # so that they are the same string objects as the constants above instead of copies parsed from the json
+    __slots__ = ("service", "endPointType", "role")
+
+    # role is either the mqtt client type (for topics) or the web type (for web services)
+    def __init__(self, service: str, endPointType: str, role: str = None):
         self.service = service
         self.endPointType = endPointType
+        self.role = role
+
+    # Kept for compatibility: they are the role of topics and web services respectively
+    @property
+    def mqttPublishOrSubscribe(self) -> str:
+        return self.role
+
+    @property
+    def webType(self) -> str:
+        return self.role
+
+    # Keys of the indexes of the catalog this end point can be found with
+    def indexKeys(self) -> list:
+        keys = [("type", self.endPointType)]
+
+        if self.role is not None:
+            keys.append(("role", self.role))
+        if self.endPointType == EndPoint.TYPE_MQTT_TOPIC:
+            keys.append(("topic", self.service))
+
+        return keys
 
     def serializeEndPoint(self) -> dict:
         e = {"service": self.service, "type": self.endPointType}
-        if self.endPointType == EndPoint.TYPE_MQTT_TOPIC:
-            e["mqttClientType"] = self.mqttPublishOrSubscribe
-        elif self.endPointType == EndPoint.TYPE_WEB_SERVICE:
-            e["webType"] = self.webType
+
+        if self.endPointType in EndPoint.ROLES:
+            e[EndPoint.ROLES[self.endPointType][0]] = self.role
 
         return e
 
@@ -29,24 +61,20 @@ class EndPoint:
         if "service" not in endPointDesc or "type" not in endPointDesc:
             raise ValueError("dict is not valid")
 
-        endPoint = EndPoint(endPointDesc["service"], endPointDesc["type"])
+        if not isinstance(endPointDesc["service"], str) or not isinstance(endPointDesc["type"], str):
+            raise ValueError("dict is not valid")
 
-        if endPoint.endPointType == EndPoint.TYPE_MQTT_TOPIC:
-            if "mqttClientType" not in endPointDesc:
-                raise ValueError("dict is not valid")
-                
-            if endPointDesc["mqttClientType"] != EndPoint.MQTT_PUBLISHER and endPointDesc["mqttClientType"] != EndPoint.MQTT_SUBSCRIBER:
-                raise ValueError("dict is not valid")
+        endPointType = endPointDesc["type"]
+        role = None
 
-            endPoint.mqttPublishOrSubscribe = endPointDesc["mqttClientType"]
+        if endPointType in EndPoint.ROLES:
+            roleField, roles = EndPoint.ROLES[endPointType]
 
-        elif endPoint.endPointType == EndPoint.TYPE_WEB_SERVICE:
-            if "webType" not in endPointDesc:
+            if roleField not in endPointDesc or endPointDesc[roleField] not in roles:
                 raise ValueError("dict is not valid")
 
-            if endPointDesc["webType"] != EndPoint.WEB_TYPE_PRODUCER and endPointDesc["webType"] != EndPoint.WEB_TYPE_CONSUMER:
-                raise ValueError("dict is not valid")
+            role = sys.intern(endPointDesc[roleField])
 
-            endPoint.webType = endPointDesc["webType"]
+        endPointType = sys.intern(endPointType)
 
-        return endPoint
\ No newline at end of file
+        return EndPoint(endPointDesc["service"], endPointType, role)
@@ -0,0 +1,199 @@
+# GorillaBlock class
+from array import array
+from typing import List, Tuple
+
+class GorillaBlock:
+    # Compressed block of consecutive readings of the temperature log, encoded as in Facebook's Gorilla:
+    # timestamps are stored as delta-of-delta and values as the XOR with the previous value, both bit-packed.
+    # Timestamps are encoded as integer milliseconds when that's lossless (as for the millis()-based ones of the Yun),
+    # otherwise they are XOR-encoded like the values. Base name, name and unit ids are stored once if they are the same
+    # for the whole block, as they usually are. Decoding gives back exactly the same readings.
+    def __init__(self, firstSeq: int, timestamps: array, values: array, baseNameIDs: array, nameIDs: array, unitIDs: array):
+        self.firstSeq = firstSeq
+        self.count = len(timestamps)
+        self.minT = min(timestamps)
+        self.maxT = max(timestamps)
+
+        self.millis = all(abs(t) < 1e12 and round(t * 1000) / 1000 == t for t in timestamps)
+
+        writer = BitWriter()
+        if self.millis:
+            GorillaBlock.encodeDeltaOfDelta(writer, [round(t * 1000) for t in timestamps])
+        else:
+            GorillaBlock.encodeXOR(writer, timestamps)
+        GorillaBlock.encodeXOR(writer, values)
+        self.data = writer.getBytes()
+
+        self.baseNameIDs = GorillaBlock.packIDs(baseNameIDs)
+        self.nameIDs = GorillaBlock.packIDs(nameIDs)
+        self.unitIDs = GorillaBlock.packIDs(unitIDs)
+
+    # Returns the columns of the block: timestamps, values, base name ids, name ids and unit ids
+    def decode(self) -> Tuple[List[float], List[float], List[int], List[int], List[int]]:
+        reader = BitReader(self.data)
+
+        if self.millis:
+            timestamps = [t / 1000 for t in GorillaBlock.decodeDeltaOfDelta(reader, self.count)]
+        else:
+            timestamps = GorillaBlock.decodeXOR(reader, self.count)
+        values = GorillaBlock.decodeXOR(reader, self.count)
+
+        return (timestamps, values, self.unpackIDs(self.baseNameIDs), self.unpackIDs(self.nameIDs), self.unpackIDs(self.unitIDs))
+
+    @staticmethod
+    def packIDs(ids: array):
+        if all(i == ids[0] for i in ids):
+            return ids[0]
+
+        return ids.tobytes()
+
+    def unpackIDs(self, ids) -> List[int]:
+        if isinstance(ids, int):
+            return [ids] * self.count
+
+        return array("H", ids).tolist()
+
+    @staticmethod
+    def encodeDeltaOfDelta(writer, ints: List[int]):
+        writer.write(ints[0] & 0xFFFFFFFFFFFFFFFF, 64)
+
+        previous = ints[0]
+        previousDelta = 0
+
+        for i in ints[1:]:
+            delta = i - previous
+            deltaOfDelta = delta - previousDelta
+            previous, previousDelta = i, delta
+
+            if deltaOfDelta == 0:
+                writer.write(0b0, 1)
+            elif -63 <= deltaOfDelta <= 64:
+                writer.write(0b10, 2)
+                writer.write(deltaOfDelta & 0x7F, 7)
+            elif -255 <= deltaOfDelta <= 256:
+                writer.write(0b110, 3)
+                writer.write(deltaOfDelta & 0x1FF, 9)
+            elif -2047 <= deltaOfDelta <= 2048:
+                writer.write(0b1110, 4)
+                writer.write(deltaOfDelta & 0xFFF, 12)
+            else:
+                writer.write(0b1111, 4)
+                writer.write(deltaOfDelta & 0xFFFFFFFFFFFFFFFF, 64)
+
+    @staticmethod
+    def decodeDeltaOfDelta(reader, count: int) -> List[int]:
+        ints = [GorillaBlock.signed(reader.read(64), 64)]
+        previousDelta = 0
+
+        for _ in range(count - 1):
+            if reader.read(1) == 0:
+                deltaOfDelta = 0
+            elif reader.read(1) == 0:
+                deltaOfDelta = GorillaBlock.signed(reader.read(7), 7)
+            elif reader.read(1) == 0:
+                deltaOfDelta = GorillaBlock.signed(reader.read(9), 9)
+            elif reader.read(1) == 0:
+                deltaOfDelta = GorillaBlock.signed(reader.read(12), 12)
+            else:
+                deltaOfDelta = GorillaBlock.signed(reader.read(64), 64)
+
+            previousDelta += deltaOfDelta
+            ints.append(ints[-1] + previousDelta)
+
+        return ints
+
+    # The bucket boundaries of delta-of-delta are asymmetric (e.g. [-63, 64]), so 64 is encoded as -64
+    @staticmethod
+    def signed(value: int, bits: int) -> int:
+        if value >= 1 << (bits - 1) and not (bits < 64 and value == 1 << (bits - 1)):
+            return value - (1 << bits)
+
+        return value
+
+    @staticmethod
+    def encodeXOR(writer, floats):
+        bits = array("Q", array("d", floats).tobytes())
+        writer.write(bits[0], 64)
+
+        previous = bits[0]
+        previousLeading, previousTrailing = -1, -1
+
+        for b in bits[1:]:
+            xor = b ^ previous
+            previous = b
+
+            if xor == 0:
+                writer.write(0b0, 1)
+                continue
+
+            leading = min(64 - xor.bit_length(), 31)
+            trailing = (xor & -xor).bit_length() - 1
+
+            if previousLeading != -1 and leading >= previousLeading and trailing >= previousTrailing:
+                # The meaningful bits fit in the window of the previous value
+                writer.write(0b10, 2)
+                writer.write(xor >> previousTrailing, 64 - previousLeading - previousTrailing)
+            else:
+                meaningful = 64 - leading - trailing
+                writer.write(0b11, 2)
+                writer.write(leading, 5)
+                writer.write(meaningful & 0x3F, 6) # 64 meaningful bits are written as 0
+                writer.write(xor >> trailing, meaningful)
+                previousLeading, previousTrailing = leading, trailing
+
+    @staticmethod
+    def decodeXOR(reader, count: int) -> List[float]:
+        bits = array("Q", [reader.read(64)])
+        previousLeading, previousTrailing = 0, 0
+
+        for _ in range(count - 1):
+            if reader.read(1) == 0:
+                bits.append(bits[-1])
+                continue
+
+            if reader.read(1) == 1:
+                previousLeading = reader.read(5)
+                meaningful = reader.read(6) or 64
+                previousTrailing = 64 - previousLeading - meaningful
+
+            meaningful = 64 - previousLeading - previousTrailing
+            bits.append(bits[-1] ^ (reader.read(meaningful) << previousTrailing))
+
+        return array("d", bits.tobytes()).tolist()
+
+# Helper classes to write and read bit-packed data
+
+class BitWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.accumulator = 0
+        self.bits = 0
+
+    def write(self, value: int, bits: int):
+        self.accumulator = (self.accumulator << bits) | value
+        self.bits += bits
+
+        while self.bits >= 8:
+            self.bits -= 8
+            self.buffer.append(self.accumulator >> self.bits)
+            self.accumulator &= (1 << self.bits) - 1
+
+    def getBytes(self) -> bytes:
+        if self.bits > 0:
+            return bytes(self.buffer) + bytes([self.accumulator << (8 - self.bits)])
+
+        return bytes(self.buffer)
+
+class BitReader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.position = 0
+
+    def read(self, bits: int) -> int:
+        start = self.position >> 3
+        end = (self.position + bits + 7) >> 3
+        chunk = int.from_bytes(self.data[start:end], "big")
+
+        self.position += bits
+
+        return (chunk >> ((end << 3) - self.position)) & ((1 << bits) - 1)
@@ -0,0 +1,246 @@
+# SegmentStore class
+from array import array
+from typing import List, Tuple
+
+import json
+import mmap
+import os
+import struct
+import threading
+
+class SegmentStore:
+    # Each reading is stored as a fixed-size binary record: t, v, base name id, name id, unit id
+    RECORD = struct.Struct("<ddHHHxx")
+
+    # Append-only on-disk storage for the readings of the temperature log.
+    # Readings are appended to segment files named after the sequence number of their first record. A new segment is
+    # started when the current one reaches segmentSize bytes. Within a segment, a new run is started whenever a reading
+    # is older than the previous one (e.g. after the Yun reboots), so that every run is sorted by timestamp and can be
+    # binary searched. The first record of every run but the first one is listed in a ".runs" file next to the segment.
+    # Segments are read back through mmap, so old data is paged in by the OS instead of being loaded on the Python heap.
+    # If maxSegments is specified, the oldest segments are deleted when there are more than that.
+    def __init__(self, directory: str, segmentSize: int = 64 * 1024 * 1024, maxSegments: int = None):
+        self.directory = directory
+        self.segmentSize = segmentSize - segmentSize % SegmentStore.RECORD.size
+        self.maxSegments = maxSegments
+
+        # Interned strings, persisted next to the segments
+        self.symbolsFile = os.path.join(self.directory, "symbols.json")
+        self.symbols = []
+        self.symbolIDs = {}
+
+        # One [firstSeq, count, path, mmap, runs] entry per segment, sorted by firstSeq,
+        # with runs the [firstRecord, firstT, lastT] of each of its runs
+        self.segments = []
+        self.activeFile = None
+
+        self.lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok = True)
+        self.open()
+
+    # Re-opens the existing segments: only the records at the boundaries of their runs are read
+    def open(self):
+        try:
+            with open(self.symbolsFile) as f:
+                self.symbols = json.load(f)
+        except FileNotFoundError:
+            pass
+        self.symbolIDs = {s: i for i, s in enumerate(self.symbols)}
+
+        for fileName in sorted(f for f in os.listdir(self.directory) if f.endswith(".seg")):
+            path = os.path.join(self.directory, fileName)
+
+            # Drop a partially written record, if any (e.g. after a crash)
+            size = os.path.getsize(path)
+            if size % SegmentStore.RECORD.size != 0:
+                size -= size % SegmentStore.RECORD.size
+                os.truncate(path, size)
+
+            if size == 0:
+                os.remove(path)
+                continue
+
+            segment = [int(fileName[:-4]), size // SegmentStore.RECORD.size, path, None, []]
+            self.mapSegment(segment)
+            self.loadRuns(segment)
+            self.segments.append(segment)
+
+        # Keep appending to the last segment
+        if len(self.segments) > 0:
+            self.activeFile = open(self.segments[-1][2], "ab", buffering = 0)
+
+    @property
+    def firstSeq(self) -> int:
+        if len(self.segments) == 0:
+            return 0
+
+        return self.segments[0][0]
+
+    @property
+    def nextSeq(self) -> int:
+        if len(self.segments) == 0:
+            return 0
+
+        return self.segments[-1][0] + self.segments[-1][1]
+
+    # (Re)creates the mapping of a segment, to see the records appended since the last time
+    def mapSegment(self, segment: list):
+        if segment[3] is not None:
+            segment[3].close()
+
+        with open(segment[2], "rb") as f:
+            segment[3] = mmap.mmap(f.fileno(), segment[1] * SegmentStore.RECORD.size, access = mmap.ACCESS_READ)
+
+    @staticmethod
+    def runsPath(segment: list) -> str:
+        return segment[2][:-4] + ".runs"
+
+    # Rebuilds the runs of a re-opened segment from its ".runs" file
+    def loadRuns(self, segment: list):
+        starts = array("Q")
+        try:
+            with open(SegmentStore.runsPath(segment), "rb") as f:
+                data = f.read()
+            starts.frombytes(data[:len(data) - len(data) % starts.itemsize])
+        except FileNotFoundError:
+            pass
+
+        # A run may have been listed before its first record was written (e.g. after a crash)
+        starts = [0] + sorted(set(start for start in starts if 0 < start < segment[1]))
+        ends = starts[1:] + [segment[1]]
+
+        segment[4] = [[start, self.timestampAt(segment, start), self.timestampAt(segment, end - 1)] for start, end in zip(starts, ends)]
+
+    @staticmethod
+    def timestampAt(segment: list, i: int) -> float:
+        return SegmentStore.RECORD.unpack_from(segment[3], i * SegmentStore.RECORD.size)[0]
+
+    def intern(self, symbol: str) -> int:
+        symbolID = self.symbolIDs.get(symbol)
+
+        if symbolID is None:
+            if len(self.symbols) == 0xFFFF:
+                raise ValueError("Too many distinct names and units")
+
+            symbolID = len(self.symbols)
+            self.symbols.append(symbol)
+            self.symbolIDs[symbol] = symbolID
+
+            # New names are rare: just rewrite the whole table
+            tmpFile = self.symbolsFile + ".tmp"
+            with open(tmpFile, "w") as f:
+                json.dump(self.symbols, f)
+            os.replace(tmpFile, self.symbolsFile)
+
+        return symbolID
+
+    # Appends (baseName, name, t, v, unit) readings, which get the sequence numbers following nextSeq
+    def appendMany(self, readings: List[tuple]):
+        with self.lock:
+            records = bytearray()
+            firstSeq = self.nextSeq
+
+            for baseName, name, t, v, unit in readings:
+                segment = self.segments[-1] if len(self.segments) > 0 else None
+
+                # Start a new segment if the active one is full
+                if segment is None or segment[1] * SegmentStore.RECORD.size >= self.segmentSize:
+                    self.flush(records)
+                    records = bytearray()
+
+                    if segment is not None:
+                        self.activeFile.close()
+                        self.mapSegment(segment)
+
+                    segment = [firstSeq, 0, os.path.join(self.directory, "%020d.seg" % firstSeq), None, []]
+                    self.segments.append(segment)
+                    self.activeFile = open(segment[2], "ab", buffering = 0)
+
+                    # Enforce the retention
+                    while self.maxSegments is not None and len(self.segments) > self.maxSegments:
+                        oldest = self.segments.pop(0)
+                        if oldest[3] is not None:
+                            oldest[3].close()
+                        os.remove(oldest[2])
+                        if os.path.exists(SegmentStore.runsPath(oldest)):
+                            os.remove(SegmentStore.runsPath(oldest))
+
+                # Start a new run if the reading would break the timestamp order
+                runs = segment[4]
+                if len(runs) == 0 or t < runs[-1][2]:
+                    # Listed before the records are written, so that it's never missing
+                    if len(runs) > 0:
+                        with open(SegmentStore.runsPath(segment), "ab") as f:
+                            f.write(array("Q", [segment[1]]).tobytes())
+
+                    runs.append([segment[1], t, t])
+                else:
+                    runs[-1][2] = t
+
+                records += SegmentStore.RECORD.pack(t, v, self.intern(baseName), self.intern(name), self.intern(unit))
+                segment[1] += 1
+                firstSeq += 1
+
+            self.flush(records)
+
+    def flush(self, records: bytearray):
+        if len(records) > 0:
+            self.activeFile.write(records)
+
+    # Returns the (baseName, name, t, v, unit) readings with a timestamp in [fromT, toT] and a sequence number
+    # in [startSeq, endSeq), at most limit of them, together with the sequence number to resume from.
+    def query(self, fromT: float, toT: float, startSeq: int, endSeq: int, limit: int = None) -> Tuple[List[tuple], int]:
+        with self.lock:
+            readings = []
+
+            for segment in self.segments:
+                segmentFirstSeq, count, runs = segment[0], segment[1], segment[4]
+
+                # Skip the segments outside of the requested range
+                if segmentFirstSeq + count <= startSeq:
+                    continue
+                if segmentFirstSeq >= endSeq:
+                    break
+
+                # The active segment may have grown since it was mapped
+                if segment[3] is None or len(segment[3]) < count * SegmentStore.RECORD.size:
+                    self.mapSegment(segment)
+
+                for r, (runStart, runFirstT, runLastT) in enumerate(runs):
+                    runEnd = runs[r + 1][0] if r + 1 < len(runs) else count
+
+                    lo = max(startSeq - segmentFirstSeq, runStart)
+                    hi = min(endSeq - segmentFirstSeq, runEnd)
+
+                    # Skip the runs outside of the requested ranges
+                    if lo >= hi or (fromT is not None and runLastT < fromT) or (toT is not None and runFirstT > toT):
+                        continue
+
+                    if fromT is not None:
+                        lo = self.searchSegment(segment[3], lo, hi, fromT, False)
+                    if toT is not None:
+                        hi = self.searchSegment(segment[3], lo, hi, toT, True)
+
+                    for i in range(lo, hi):
+                        if limit is not None and len(readings) == limit:
+                            return readings, segmentFirstSeq + i
+
+                        t, v, baseNameID, nameID, unitID = SegmentStore.RECORD.unpack_from(segment[3], i * SegmentStore.RECORD.size)
+                        readings.append((self.symbols[baseNameID], self.symbols[nameID], t, v, self.symbols[unitID]))
+
+            return readings, endSeq
+
+    # Returns the first record in [lo, hi) whose timestamp is >= t (or > t if after is True)
+    @staticmethod
+    def searchSegment(records: mmap.mmap, lo: int, hi: int, t: float, after: bool) -> int:
+        while lo < hi:
+            mid = (lo + hi) // 2
+            midT = SegmentStore.RECORD.unpack_from(records, mid * SegmentStore.RECORD.size)[0]
+
+            if midT < t or (after and midT == t):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
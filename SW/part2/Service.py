@@ -2,16 +2,26 @@
 from EndPoint import EndPoint
 
 class Service:
-    def __init__(self, serviceID: str):
+    # No per-instance dict, as the catalog may hold many services
+    __slots__ = ("serviceID", "description", "endPoints", "timestamp")
+
+    def __init__(self, serviceID: str, endPoints: tuple = ()):
         self.serviceID = serviceID
         self.description = ""
-        self.endPoints = []
+        self.endPoints = tuple(endPoints)
+        self.timestamp = None
 
     def addDescription(self, description: str):
         self.description = description
 
     def addEndPoint(self, endPoint: EndPoint):
-        self.endPoints.append(endPoint)
+        self.endPoints += (endPoint,)
+
+    # Keys of the indexes of the catalog this service can be found with, each one with the position of the matching end point
+    def indexKeys(self):
+        for i, e in enumerate(self.endPoints):
+            for key in e.indexKeys():
+                yield key, i
 
     def serialize(self) -> dict:
         # Serializes the current Service object and returns a dict representing the same entity
@@ -28,15 +38,18 @@ class Service:
         if "serviceID" not in serviceDesc or "description" not in serviceDesc or "endPoints" not in serviceDesc:
             raise ValueError("JSON doesn't contain necessary params")
 
-        s = Service(serviceDesc["serviceID"])
+        # IDs are used in URLs and to sort the catalog
+        if not isinstance(serviceDesc["serviceID"], str):
+            raise ValueError("serviceID must be a string")
+
+        # Parse the endpoints
+        try:
+            endPoints = tuple(EndPoint.parseEndPoint(endPointDesc) for endPointDesc in serviceDesc["endPoints"])
+        except:
+            # Raise another exception with proper description
+            raise ValueError("End point is not valid")
+
+        s = Service(serviceDesc["serviceID"], endPoints)
         s.addDescription(serviceDesc["description"])
 
-        # Now add the endpoints
-        for endPointDesc in serviceDesc["endPoints"]:
-            try:
-                s.addEndPoint(EndPoint.parseEndPoint(endPointDesc))
-            except:
-                # Raise another exception with proper description
-                raise ValueError("End point is not valid")
-        
         return s
\ No newline at end of file
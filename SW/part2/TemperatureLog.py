@@ -0,0 +1,388 @@
+# TemperatureLog class
+from Rollups import Rollups
+from SegmentStore import SegmentStore
+from GorillaBlock import GorillaBlock
+from array import array
+from typing import List, Tuple
+
+import bisect
+import math
+import os
+import threading
+
+class TemperatureLog:
+    # Number of readings in each block of the compressed history
+    BLOCK_SIZE = 1024
+
+    # Number of readings after which the rollups are saved next to the segments
+    ROLLUPS_SAVE_INTERVAL = 65536
+
+    # Fixed-capacity columnar store for the SenML readings received by the web service.
+    # Timestamps and values are kept in array('d') columns, while base names, names and units are interned
+    # in a small table and stored as 16-bit ids. Once the log is full, the oldest readings are overwritten.
+    # If historyCapacity is specified, the readings evicted from the ring buffer are moved to a compressed history
+    # of GorillaBlocks holding up to that many readings, which are decoded only when a query needs them.
+    # If segmentStore is specified, every reading is also persisted there: the log then only keeps the most recent
+    # readings in memory, and older ones are read back from the segments. The rollups are saved there as well from time
+    # to time, and on restart only the readings persisted after they were saved are added to them again.
+    def __init__(self, capacity: int, segmentStore: SegmentStore = None, historyCapacity: int = 0):
+        if capacity <= 0:
+            raise ValueError("Capacity must be positive")
+
+        self.capacity = capacity
+
+        # Columns, used as a ring buffer
+        self.timestamps  = array("d", bytes(8 * capacity))
+        self.values      = array("d", bytes(8 * capacity))
+        self.baseNameIDs = array("H", bytes(2 * capacity))
+        self.nameIDs     = array("H", bytes(2 * capacity))
+        self.unitIDs     = array("H", bytes(2 * capacity))
+
+        self.head = 0  # Position of the oldest reading
+        self.count = 0 # Number of readings currently stored
+
+        # Every reading gets a sequence number, which never changes and is used as a cursor
+        self.nextSeq = 0
+
+        # Sequence numbers where the timestamps stop being non-decreasing (e.g. the Yun rebooted and millis()
+        # restarted from 0). Between two of them the readings are sorted by timestamp, so they can be binary searched
+        self.runStarts = []
+
+        # Compressed history: sealed blocks sorted by sequence number, plus the readings waiting to fill the next block
+        self.historyCapacity = historyCapacity
+        self.historyBlocks = []
+        self.historyBlockSeqs = [] # firstSeq of each block, to bisect on
+        self.historyCount = 0
+        self.staging = TemperatureLog.emptyColumns()
+        self.stagingFirstSeq = 0
+
+        # Interned strings
+        self.symbols = []
+        self.symbolIDs = {}
+
+        # CherryPy serves requests from several threads
+        self.lock = threading.Lock()
+
+        # Aggregates of the readings, which outlive the readings themselves
+        self.rollups = Rollups()
+
+        # Last block decoded by a query, as (block, columns), so that paging through a block decodes it only once
+        self.decodedBlock = (None, None)
+
+        self.segmentStore = segmentStore
+
+        if self.segmentStore is not None:
+            self.rollupsFile = os.path.join(self.segmentStore.directory, "rollups.json")
+            self.rollupsSavedSeq = self.rollups.load(self.rollupsFile)
+
+            # Without saved rollups (or with rollups newer than the segments), rebuild them from all the segments
+            if self.rollupsSavedSeq is None or self.rollupsSavedSeq > self.segmentStore.nextSeq:
+                self.rollups = Rollups()
+                self.rollupsSavedSeq = self.segmentStore.firstSeq
+
+            # Load the readings of the ring buffer persisted before the restart, a block at a time. The history is not
+            # rebuilt: it fills up again as the ring buffer evicts readings, and until then the older ones are read from
+            # the segments. The older readings are only added to the rollups, if they're not in there yet
+            self.nextSeq = max(self.segmentStore.nextSeq - self.capacity, self.segmentStore.firstSeq)
+            seq = max(min(self.rollupsSavedSeq, self.nextSeq), self.segmentStore.firstSeq)
+
+            while seq < self.segmentStore.nextSeq:
+                for baseName, name, t, v, unit in self.segmentStore.query(None, None, seq, self.segmentStore.nextSeq, TemperatureLog.BLOCK_SIZE)[0]:
+                    if seq >= self.nextSeq:
+                        self.appendLocked(self.intern(baseName), self.intern(name), t, v, self.intern(unit), seq >= self.rollupsSavedSeq)
+                    else:
+                        self.rollups.add(name, unit, t, v)
+                    seq += 1
+
+    def __len__(self) -> int:
+        return self.count
+
+    # Returns the id of the specified string, adding it to the table if needed
+    def intern(self, symbol: str) -> int:
+        symbolID = self.symbolIDs.get(symbol)
+
+        if symbolID is None:
+            if not isinstance(symbol, str):
+                raise TypeError("Names and units must be strings")
+            if len(self.symbols) == 0xFFFF:
+                raise ValueError("Too many distinct names and units")
+
+            symbolID = len(self.symbols)
+            self.symbols.append(symbol)
+            self.symbolIDs[symbol] = symbolID
+
+        return symbolID
+
+    # Adds a reading to the log, evicting the oldest one if the log is full.
+    # Raises TypeError or ValueError if the reading is not valid.
+    def append(self, baseName: str, name: str, t: float, v: float, unit: str):
+        self.appendMany([(baseName, name, float(t), float(v), unit)])
+
+    # Adds several (baseName, name, t, v, unit) readings at once, as returned by parseSenML(...)
+    def appendMany(self, readings: List[tuple]):
+        with self.lock:
+            # Intern everything first, so that either all the readings are added or none of them
+            symbolIDs = [(self.intern(baseName), self.intern(name), self.intern(unit)) for baseName, name, _, _, unit in readings]
+
+            if self.segmentStore is not None:
+                self.segmentStore.appendMany(readings)
+
+            for (baseNameID, nameID, unitID), (_, _, t, v, _) in zip(symbolIDs, readings):
+                self.appendLocked(baseNameID, nameID, t, v, unitID)
+
+            if self.segmentStore is not None and self.nextSeq - self.rollupsSavedSeq >= TemperatureLog.ROLLUPS_SAVE_INTERVAL:
+                self.rollups.save(self.rollupsFile, self.nextSeq)
+                self.rollupsSavedSeq = self.nextSeq
+
+    def appendLocked(self, baseNameID: int, nameID: int, t: float, v: float, unitID: int, rollup: bool = True):
+        # A reading older than the previous one starts a new sorted run
+        if self.count == 0 or t < self.timestamps[(self.head + self.count - 1) % self.capacity]:
+            self.runStarts.append(self.nextSeq)
+
+        if self.count < self.capacity:
+            position = (self.head + self.count) % self.capacity
+            self.count += 1
+        else:
+            # Overwrite the oldest reading, after moving it to the history
+            position = self.head
+            self.head = (self.head + 1) % self.capacity
+
+            if self.historyCapacity > 0:
+                self.archive(position, self.nextSeq - self.count)
+
+            # Forget the runs that have been evicted completely
+            oldestSeq = self.nextSeq + 1 - self.count
+            while len(self.runStarts) > 1 and self.runStarts[1] <= oldestSeq:
+                self.runStarts.pop(0)
+
+        self.nextSeq += 1
+
+        self.timestamps[position] = t
+        self.values[position] = v
+        self.baseNameIDs[position] = baseNameID
+        self.nameIDs[position] = nameID
+        self.unitIDs[position] = unitID
+
+        if rollup:
+            self.rollups.add(self.symbols[nameID], self.symbols[unitID], t, v)
+
+    # Moves the reading at the specified position of the ring buffer to the compressed history
+    def archive(self, position: int, seq: int):
+        if len(self.staging[0]) == 0:
+            self.stagingFirstSeq = seq
+
+        for column, ringColumn in zip(self.staging, (self.timestamps, self.values, self.baseNameIDs, self.nameIDs, self.unitIDs)):
+            column.append(ringColumn[position])
+        self.historyCount += 1
+
+        if len(self.staging[0]) == TemperatureLog.BLOCK_SIZE:
+            # Seal the block
+            self.historyBlocks.append(GorillaBlock(self.stagingFirstSeq, *self.staging))
+            self.historyBlockSeqs.append(self.stagingFirstSeq)
+            self.staging = TemperatureLog.emptyColumns()
+
+            # Drop the oldest blocks if the history is too long
+            while len(self.historyBlocks) > 0 and self.historyCount > self.historyCapacity:
+                self.historyCount -= self.historyBlocks.pop(0).count
+                self.historyBlockSeqs.pop(0)
+
+    # Sequence number of the oldest reading in the history
+    def historyFirstSeq(self) -> int:
+        if len(self.historyBlocks) > 0:
+            return self.historyBlocks[0].firstSeq
+        if len(self.staging[0]) > 0:
+            return self.stagingFirstSeq
+
+        return self.nextSeq - self.count
+
+    @staticmethod
+    def emptyColumns() -> tuple:
+        return (array("d"), array("d"), array("H"), array("H"), array("H"))
+
+    # Validates a SenML pack and returns the (baseName, name, t, v, unit) readings it contains.
+    # The pack may hold any number of records in "e", and the base fields "bn", "bt", "bv" and "bu"
+    # are applied to each of them. Raises ValueError if the pack or any of its records is not valid.
+    @staticmethod
+    def parseSenML(pack: dict) -> List[tuple]:
+        if not isinstance(pack, dict) or "bn" not in pack or not isinstance(pack.get("e"), list) or len(pack["e"]) == 0:
+            raise ValueError("Pack is not valid")
+
+        baseName = pack["bn"]
+        baseUnit = pack.get("bu")
+
+        try:
+            baseTime = float(pack.get("bt", 0))
+            baseValue = float(pack.get("bv", 0))
+        except (TypeError, ValueError):
+            raise ValueError("Base time or value is not valid")
+
+        readings = []
+
+        for record in pack["e"]:
+            if not isinstance(record, dict) or "n" not in record or "v" not in record:
+                raise ValueError("Record is not valid")
+
+            # Without a base time, every record needs its own
+            if "t" not in record and "bt" not in pack:
+                raise ValueError("Record has no time")
+
+            unit = record.get("u", baseUnit)
+            if not isinstance(record["n"], str) or not isinstance(unit, str):
+                raise ValueError("Record has no valid name or unit")
+
+            try:
+                t = baseTime + float(record.get("t", 0))
+                v = baseValue + float(record["v"])
+            except (TypeError, ValueError):
+                raise ValueError("Record has no valid time or value")
+
+            if not math.isfinite(t) or not math.isfinite(v):
+                raise ValueError("Record has no valid time or value")
+
+            readings.append((baseName, record["n"], t, v, unit))
+
+        return readings
+
+    # Rebuilds the SenML representation of every reading in the ring buffer, from the oldest to the newest
+    def toSenML(self) -> List[dict]:
+        with self.lock:
+            return [self.positionToSenML((self.head + i) % self.capacity) for i in range(self.count)]
+
+    # Returns the readings with a timestamp in [fromT, toT] and a sequence number not lower than cursor,
+    # in the order they were received, together with the cursor to use to get the following ones.
+    # At most limit readings are returned. Every parameter is optional.
+    # Each sorted run is binary searched, so the cost is O(log n + k) for k returned readings.
+    def query(self, fromT: float = None, toT: float = None, cursor: int = None, limit: int = None) -> Tuple[List[dict], int]:
+        with self.lock:
+            oldestSeq = self.nextSeq - self.count
+            historySeq = self.historyFirstSeq()
+            startSeq = 0 if cursor is None else cursor
+
+            readings = []
+
+            # Readings that are not in memory anymore are read from the segments
+            if self.segmentStore is not None and startSeq < historySeq:
+                persistedReadings, resumeSeq = self.segmentStore.query(fromT, toT, startSeq, historySeq, limit)
+                readings = [self.readingToSenML(*r) for r in persistedReadings]
+
+                if limit is not None and len(readings) == limit:
+                    return readings, resumeSeq
+
+            # Then come the ones in the compressed history
+            if startSeq < oldestSeq and historySeq < oldestSeq:
+                resumeSeq = self.queryHistory(fromT, toT, max(startSeq, historySeq), readings, limit)
+
+                if resumeSeq is not None:
+                    return readings, resumeSeq
+
+            startSeq = max(startSeq, oldestSeq)
+
+            # Skip the runs that end before the cursor
+            firstRun = max(bisect.bisect_right(self.runStarts, startSeq) - 1, 0)
+
+            for i in range(firstRun, len(self.runStarts)):
+                lo = max(self.runStarts[i], startSeq)
+                hi = self.runStarts[i + 1] if i + 1 < len(self.runStarts) else self.nextSeq
+
+                if fromT is not None:
+                    lo = self.searchRun(lo, hi, fromT, False)
+                if toT is not None:
+                    hi = self.searchRun(lo, hi, toT, True)
+
+                for seq in range(lo, hi):
+                    if limit is not None and len(readings) == limit:
+                        # Resume from here on the next call
+                        return readings, seq
+
+                    readings.append(self.positionToSenML(self.seqToPosition(seq)))
+
+            # Everything received so far has been looked at
+            return readings, self.nextSeq
+
+    # Adds the readings of the history matching the query to readings. Only the blocks overlapping the requested
+    # ranges are decoded. Returns the sequence number to resume from if the limit is reached, None otherwise.
+    def queryHistory(self, fromT: float, toT: float, startSeq: int, readings: List[dict], limit: int) -> int:
+        # Skip the blocks that end before startSeq
+        firstBlock = max(bisect.bisect_right(self.historyBlockSeqs, startSeq) - 1, 0)
+
+        for block in self.historyBlocks[firstBlock:]:
+            if block.firstSeq + block.count <= startSeq or (fromT is not None and block.maxT < fromT) or (toT is not None and block.minT > toT):
+                continue
+
+            if self.decodedBlock[0] is not block:
+                self.decodedBlock = (block, block.decode())
+
+            resumeSeq = self.scanColumns(block.firstSeq, self.decodedBlock[1], fromT, toT, startSeq, readings, limit)
+            if resumeSeq is not None:
+                return resumeSeq
+
+        return self.scanColumns(self.stagingFirstSeq, self.staging, fromT, toT, startSeq, readings, limit)
+
+    def scanColumns(self, firstSeq: int, columns: tuple, fromT: float, toT: float, startSeq: int, readings: List[dict], limit: int) -> int:
+        timestamps, values, baseNameIDs, nameIDs, unitIDs = columns
+
+        for i in range(max(startSeq - firstSeq, 0), len(timestamps)):
+            t = timestamps[i]
+            if (fromT is not None and t < fromT) or (toT is not None and t > toT):
+                continue
+
+            if limit is not None and len(readings) == limit:
+                return firstSeq + i
+
+            readings.append(self.readingToSenML(self.symbols[baseNameIDs[i]], self.symbols[nameIDs[i]], t, values[i], self.symbols[unitIDs[i]]))
+
+        return None
+
+    # Returns the aggregates of the readings at the specified resolution, see Rollups.query(...)
+    def rollup(self, resolution: str, fromT: float = None, toT: float = None) -> List[dict]:
+        with self.lock:
+            return self.rollups.query(resolution, fromT, toT)
+
+    # Validates the parameters of a query received via HTTP and converts them to the arguments of query(...)
+    # Raises ValueError if they are not valid.
+    @staticmethod
+    def parseQueryParams(params: dict) -> dict:
+        if any(p not in ("from", "to", "cursor", "limit") for p in params):
+            raise ValueError("Unknown parameter")
+
+        queryArgs = {}
+
+        if "from" in params:
+            queryArgs["fromT"] = float(params["from"])
+        if "to" in params:
+            queryArgs["toT"] = float(params["to"])
+        if "cursor" in params:
+            queryArgs["cursor"] = int(params["cursor"])
+            if queryArgs["cursor"] < 0:
+                raise ValueError("The cursor must not be negative")
+        if "limit" in params:
+            queryArgs["limit"] = int(params["limit"])
+            if queryArgs["limit"] <= 0:
+                raise ValueError("The limit must be positive")
+
+        return queryArgs
+
+    def seqToPosition(self, seq: int) -> int:
+        return (self.head + seq - (self.nextSeq - self.count)) % self.capacity
+
+    # Returns the first sequence number in [lo, hi) whose timestamp is >= t (or > t if after is True).
+    # The readings in [lo, hi) must belong to the same run.
+    def searchRun(self, lo: int, hi: int, t: float, after: bool) -> int:
+        while lo < hi:
+            mid = (lo + hi) // 2
+            midT = self.timestamps[self.seqToPosition(mid)]
+
+            if midT < t or (after and midT == t):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def positionToSenML(self, position: int) -> dict:
+        return self.readingToSenML(self.symbols[self.baseNameIDs[position]], self.symbols[self.nameIDs[position]],
+                                   self.timestamps[position], self.values[position], self.symbols[self.unitIDs[position]])
+
+    @staticmethod
+    def readingToSenML(baseName: str, name: str, t: float, v: float, unit: str) -> dict:
+        return {"bn": baseName, "e": [{"n": name, "t": t, "v": v, "u": unit}]}
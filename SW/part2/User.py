@@ -1,6 +1,9 @@
 # User class
 
 class User:
+    # No per-instance dict, like the other entities of the catalog
+    __slots__ = ("userID", "name", "surname", "email")
+
     def __init__(self, userID, name, surname, email):
         self.userID = userID
         self.name = name
@@ -17,6 +20,10 @@ class User:
         if "userID" not in userDesc or "name" not in userDesc or "surname" not in userDesc or "email" not in userDesc:
             raise ValueError("JSON doesn't contain necessary params")
 
+        # IDs are used in URLs and to sort the catalog
+        if not isinstance(userDesc["userID"], str):
+            raise ValueError("userID must be a string")
+
         u = User(userDesc["userID"], userDesc["name"], userDesc["surname"], userDesc["email"])
         
         return u
\ No newline at end of file
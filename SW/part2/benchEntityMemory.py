@@ -0,0 +1,62 @@
+from CatalogStore import CatalogStore
+from Device import Device
+
+import gc
+import sys
+import time
+import tracemalloc
+
+# Measures the memory used by the devices of the catalog, at 10k, 100k and 1M devices (or at the counts given
+# on the command line). For each count it reports the bytes per device of the Device objects alone, and of the
+# whole CatalogStore holding them (cached JSON, indexes and sorted IDs included), as traced by tracemalloc
+# (which slows the allocations down: 1M devices take a few minutes).
+# Usage: python benchEntityMemory.py [count ...]
+RESOURCES = ("temperature", "humidity")
+
+def makeDevice(i: int) -> Device:
+    deviceID = "device%07d" % i
+
+    # Parsed from json like the registrations, so that the strings are not shared more than they'd be in the catalog
+    d = Device.parseDevice({
+        "deviceID": deviceID,
+        "resources": list(RESOURCES),
+        "endPoints": [{"service": "/tiot/19/" + deviceID + "/" + r, "type": "mqttTopic", "mqttClientType": "publisher"} for r in RESOURCES]
+    })
+    d.timestamp = "2020-01-01 00:00:00.000000"
+
+    return d
+
+# Returns the bytes per device of the devices alone and of the store holding them
+def measure(count: int) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+
+    devices = [makeDevice(i) for i in range(count)]
+    devicesSize = tracemalloc.get_traced_memory()[0] - start
+
+    store = CatalogStore()
+    for i in range(0, count, 1000):
+        store.upsertMany("devices", [(d.deviceID, d) for d in devices[i:i + 1000]])
+
+    # Build the sorted IDs, as the first paginated list does
+    store.page("devices", None, 1)
+
+    # Only the store references the devices now
+    del devices
+    gc.collect()
+    storeSize = tracemalloc.get_traced_memory()[0] - start
+
+    tracemalloc.stop()
+    del store
+
+    return devicesSize / count, storeSize / count
+
+if __name__ == "__main__":
+    counts = [int(c) for c in sys.argv[1:]] if len(sys.argv) > 1 else [10000, 100000, 1000000]
+
+    for count in counts:
+        t = time.monotonic()
+        deviceBytes, storeBytes = measure(count)
+
+        print("%8d devices: %6.0f bytes/device (Device objects), %6.0f bytes/device (CatalogStore), %.1f s" % (count, deviceBytes, storeBytes, time.monotonic() - t))
@@ -0,0 +1,108 @@
+import paho.mqtt.client as PahoMQTT
+import requests
+import json
+import sys
+import threading
+import time
+
+# Measures how many device registrations per second the catalog (es05) sustains via MQTT, at QoS 1 and QoS 2.
+# Each run publishes count distinct registrations to the catalog, as fast as the broker accepts them, and then
+# waits until the last device can be read back from the catalog (registrations are processed in the order
+# they arrive, so by then all the previous ones have been processed too).
+# Usage: python benchMQTTRegistrations.py [catalogURL] [catalogPORT] [count]
+class RegistrationBenchmark:
+    def __init__(self, catalogURL: str, catalogPORT: int):
+        self.catalogURL = catalogURL + ":" + str(catalogPORT)
+
+        # Gather the mqtt broker from the catalog
+        response = requests.get(self.catalogURL + "/getMQTTMessageBroker")
+        response.raise_for_status()
+        broker = json.loads(response.text)
+
+        # Publishes are acknowledged asynchronously: count them to know when the broker has taken all of them
+        self.acknowledged = 0
+        self.allAcknowledged = threading.Event()
+        self.expected = 0
+        self.lock = threading.Lock()
+
+        self.mqttClient = PahoMQTT.Client("tiot19_Registration_Benchmark", True)
+        self.mqttClient.on_publish = self.onPublish
+
+        # Let everything be in flight at once, the broker is the one throttling
+        self.mqttClient.max_inflight_messages_set(0)
+        self.mqttClient.max_queued_messages_set(0)
+
+        self.mqttClient.connect(broker["url"], broker["port"])
+        self.mqttClient.loop_start()
+
+    def onPublish(self, client, userdata, mid):
+        with self.lock:
+            self.acknowledged += 1
+
+            if self.acknowledged == self.expected:
+                self.allAcknowledged.set()
+
+    @staticmethod
+    def payload(deviceID: str) -> str:
+        return json.dumps({
+            "deviceID": deviceID,
+            "resources": ["temperature"],
+            "endPoints": [{"service": "/tiot/19/" + deviceID + "/temperature", "type": "mqttTopic", "mqttClientType": "publisher"}]
+        })
+
+    def isRegistered(self, deviceID: str) -> bool:
+        return requests.get(self.catalogURL + "/getDevice", params = {"id": deviceID}).status_code == 200
+
+    # Returns the publish rate (as acknowledged by the broker) and the rate of the registrations processed by the catalog
+    def run(self, qos: int, count: int, timeout: float = 120) -> tuple:
+        # Distinct device IDs for each run, so that no registration is just a heartbeat
+        prefix = "benchmark_" + str(qos) + "_" + str(int(time.time())) + "_"
+        payloads = [RegistrationBenchmark.payload(prefix + str(i)) for i in range(count)]
+
+        with self.lock:
+            self.acknowledged = 0
+            self.expected = count
+            self.allAcknowledged.clear()
+
+        start = time.monotonic()
+
+        for payload in payloads:
+            self.mqttClient.publish("/tiot/19/catalog/addDevice", payload, qos)
+
+        if not self.allAcknowledged.wait(timeout):
+            raise TimeoutError("The broker acknowledged only " + str(self.acknowledged) + " registrations")
+        published = time.monotonic()
+
+        while not self.isRegistered(prefix + str(count - 1)):
+            if time.monotonic() - start > timeout:
+                raise TimeoutError("The catalog didn't process all the registrations")
+            time.sleep(0.05)
+        registered = time.monotonic()
+
+        return count / (published - start), count / (registered - start)
+
+    def stop(self):
+        self.mqttClient.loop_stop()
+        self.mqttClient.disconnect()
+
+if __name__ == "__main__":
+    catalogURL = sys.argv[1] if len(sys.argv) > 1 else "http://localhost"
+    catalogPORT = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+
+    try:
+        benchmark = RegistrationBenchmark(catalogURL, catalogPORT)
+    except Exception as e:
+        print("Unable to connect: " + str(e))
+        exit(-1)
+
+    for qos in (1, 2):
+        try:
+            publishRate, registrationRate = benchmark.run(qos, count)
+        except TimeoutError as e:
+            print("QoS " + str(qos) + ": " + str(e))
+            continue
+
+        print("QoS %d: %d registrations, %.0f published/s, %.0f registered/s" % (qos, count, publishRate, registrationRate))
+
+    benchmark.stop()
@@ -3,9 +3,14 @@ from EndPoint import EndPoint
 from Device import Device
 from User import User
 from Service import Service
+from CatalogJournal import CatalogJournal, CatalogPersister
+from CatalogStore import CatalogStore
 from typing import *
 
 import datetime
+import hashlib
+import heapq
+import queue
 import threading
 import time
 import cherrypy
@@ -15,6 +20,24 @@ import paho.mqtt.client as PahoMQTT
 class RESTCatalog:
     exposed = True
 
+    # Maximum number of seconds a watch request waits for a change (without Server-Sent Events), and the default
+    watchMaxTimeout = 60
+    watchDefaultTimeout = 10
+
+    # Seconds between the keep-alive comments sent to the Server-Sent Events clients when nothing changes,
+    # and after which the stream is closed (the clients reconnect with the Last-Event-ID of the last event they got)
+    watchKeepAliveInterval = 15
+    watchStreamDuration = 300
+
+    # Every watch request holds one of the threads of cherrypy while it waits: at most watchMaxClients are served
+    # at once (the others get 503), and the pool is big enough to leave threads to the registrations anyway
+    watchMaxClients = 32
+    threadPool = 48
+
+    # Filters accepted by the queries on the end points of devices and services, which are also the names of the index keys
+    DEVICE_FILTERS  = ("resource", "topic", "type", "role")
+    SERVICE_FILTERS = ("topic", "type", "role")
+
     # Thread subclass to manage timeouts for RESTCatalog
     # It is an inner class because it's only purpose is to work together with the Catalog
     # Also, it is a class and not just a function to pass to threading.Thread because I needed a
@@ -22,50 +45,64 @@ class RESTCatalog:
     class TimeoutManagerRunner(threading.Thread, cherrypy.process.plugins.SimplePlugin):
         
         # timeout is the number of seconds after the last subscription of a service or device to the Catalog such that they must be removed then
-        # period specifies (in seconds, too) the period to check for every device and service
-        def __init__(self, catalog, bus, timeout: float, period: float):
+        def __init__(self, catalog, bus, timeout: float):
             threading.Thread.__init__(self)
             cherrypy.process.plugins.SimplePlugin.__init__(self, bus)
             
             self.catalog = catalog
             self.timeout = timeout
-            self.period = period
             
             self.running = True
 
-            # Used to wake the thread up when it's time to shutdown
-            self.wakeEvent = threading.Event()
+            # Min-heap of the (deadline, collection, entityID) of the devices and services, with time.monotonic() deadlines.
+            # When an entity registers again its old entry is not removed, but it becomes stale and is skipped once popped:
+            # this way the thread only ever looks at the entities that are expiring
+            self.deadlines = []
 
-        def run(self):
-            while self.running:
-                removed = False
-                
-                # Check all the devices
-                for device in list(self.catalog.database["devices"].values()):
-                    timestamp = datetime.datetime.strptime(device.timestamp, "%Y-%m-%d %H:%M:%S.%f")
+            # Current (deadline, entity, timestamp) of each (collection, entityID)
+            self.currentDeadlines = {}
+
+            # Protects the deadlines, and is used to wake the thread up when an earlier deadline is scheduled or it's time to shutdown
+            self.condition = threading.Condition()
+
+        # Schedules the removal of a device or a service, which registered age seconds ago
+        def schedule(self, collection: str, entityID: str, entity, age: float = 0):
+            deadline = time.monotonic() + self.timeout - age
 
-                    if datetime.datetime.now() - datetime.timedelta(seconds = self.timeout) > timestamp:
-                        print("Removing device " + device.deviceID)
-                        self.catalog.database["devices"].pop(device.deviceID)
+            with self.condition:
+                self.currentDeadlines[(collection, entityID)] = (deadline, entity, getattr(entity, "timestamp", None))
+                heapq.heappush(self.deadlines, (deadline, collection, entityID))
 
-                        removed = True
+                # The thread only needs to know if it has to wake up earlier
+                if self.deadlines[0][0] == deadline:
+                    self.condition.notify()
 
-                # Check all the services
-                for service in list(self.catalog.database["services"].values()):
-                    timestamp = datetime.datetime.strptime(service.timestamp, "%Y-%m-%d %H:%M:%S.%f")
+        def run(self):
+            while self.running:
+                expired = []
+
+                with self.condition:
+                    now = time.monotonic()
 
-                    if datetime.datetime.now() - datetime.timedelta(seconds = self.timeout) > timestamp:
-                        print("Removing service " + service.serviceID)
-                        self.catalog.database["services"].pop(service.serviceID)
+                    while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+                        deadline, collection, entityID = heapq.heappop(self.deadlines)
 
-                        removed = True
+                        # Skip the entry if the entity has registered again since
+                        current = self.currentDeadlines.get((collection, entityID))
+                        if current is not None and current[0] == deadline:
+                            del self.currentDeadlines[(collection, entityID)]
+                            expired.append((collection, entityID) + current[1:])
 
-                if removed:
-                    # If something's been removed, trigger a sync with the file storage
-                    self.catalog.serializeCatalogToJSONFile()
+                    # Sleep until the next deadline, but be ready to be woken up to shutdown
+                    if len(expired) == 0 and self.running:
+                        self.condition.wait(timeout = self.deadlines[0][0] - now if len(self.deadlines) > 0 else None)
 
-                # Wait but be ready to be woken up to shutdown
-                self.wakeEvent.wait(timeout = self.period)
+                for collection, entityID, entity, timestamp in expired:
+                    # Only remove it if it hasn't been replaced nor touched in the meantime: touch() refreshes the same
+                    # entity, so its timestamp is compared too (by the store, which updates it under the same lock)
+                    if self.catalog.store.remove(collection, entityID, entity, timestamp) is not None:
+                        print("Removing " + ("device " if collection == "devices" else "service ") + entityID)
+                        self.catalog.forgetRegistration(collection, entityID)
 
         # To be called when cherrypy stops to stop the thread
         def stop(self):
@@ -73,7 +110,8 @@ class RESTCatalog:
             self.running = False
 
             # Notify the waiting thread
-            self.wakeEvent.set()
+            with self.condition:
+                self.condition.notify()
 
             # Notify the mqtt subscriber of shutdown
             try:
@@ -82,24 +120,31 @@ class RESTCatalog:
                 pass
     
     # MQTT subscriber class to listen for device subscriptions over the mqtt protocol, too
+    # It also answers the queries of the catalog (see RESTCatalog.QUERIES) published on queryTopic as
+    #   {"query": "getDevice", "params": {"id": "Yun"}, "replyTo": "<topic>", "correlationID": <anything>}
+    # by publishing {"correlationID": <the same>, "status": <HTTP status>, "response": <the HTTP response>} on replyTo,
+    # so that the devices can look up the catalog without an HTTP client.
     class MQTTDeviceSubscriptionListener:
-        def __init__(self, mqttBrokerURL: str, mqttBrokerPORT: int, clientID: str, topic: str, catalog):
+        def __init__(self, mqttBrokerURL: str, mqttBrokerPORT: int, clientID: str, topic: str, queryTopic: str, catalog):
             self.brokerURL = mqttBrokerURL
             self.brokerPORT = mqttBrokerPORT
             self.clientID = clientID
             self.topic = topic
+            self.queryTopic = queryTopic
             self.catalog = catalog
 
             # Create the mqtt client instance and register the callbacks
             self._paho_mqtt = PahoMQTT.Client(self.clientID, True) # Transient session
             self._paho_mqtt.on_connect = self.onConnect
             self._paho_mqtt.on_message = self.onMessage
+            self._paho_mqtt.message_callback_add(self.queryTopic, self.onQuery)
 
-            # Connect to the broker and subscribe to the assigned topic
+            # Connect to the broker and subscribe to the assigned topics
             try:
                 self._paho_mqtt.connect(self.brokerURL, self.brokerPORT)
                 self._paho_mqtt.loop_start()
                 self._paho_mqtt.subscribe(self.topic, 2)
+                self._paho_mqtt.subscribe(self.queryTopic, 1)
             except:
                 print("Error connecting to mqtt broker")
 
@@ -110,38 +155,225 @@ class RESTCatalog:
                 print("Connection to MQTT broker failed: rc = " + str(rc))
 
         def onMessage(self, client, userdata, message):
-             # Parse and add the device
-            try:
-                payload = json.loads(message.payload)
-            except:
-                print("MQTT: Received invalid JSON")
-                return
- 
+            # Registrations are processed by another thread, so that this one (the only one of the mqtt client)
+            # is always free to handle the network
+            self.catalog.registrationWorkerRunner.enqueue(message.payload)
+
+        def onQuery(self, client, userdata, message):
             try:
-                d = Device.parseDevice(payload)
-            except ValueError as e:
-                print("MQTT: Invalid data in JSON: " + str(e))
+                request = json.loads(message.payload)
+
+                query, params, replyTo = request["query"], request.get("params", {}), request["replyTo"]
+                if not isinstance(replyTo, str) or not isinstance(params, dict) or not all(isinstance(v, str) for v in params.values()):
+                    raise ValueError("Invalid query")
+            except (ValueError, KeyError, TypeError):
+                print("MQTT: Received invalid query")
                 return
 
-            # Add timestamp
-            d.timestamp = str(datetime.datetime.now())
- 
-            # Now insert the newly created device into the database
-            self.catalog.database["devices"][d.deviceID] = d
+            if query in RESTCatalog.QUERIES:
+                status, response = self.catalog.query(query, params)
+            else:
+                status, response = 404, self.catalog.failureJSON("Not Found")
 
-            # Save the new JSON file
-            self.catalog.serializeCatalogToJSONFile()
+            reply = '{"correlationID": ' + json.dumps(request.get("correlationID")) + ', "status": ' + str(status) + ', "response": ' + response + "}"
 
-            print("MQTT: Device added/updated successfully")
+            try:
+                self._paho_mqtt.publish(replyTo, reply, 1)
+            except ValueError:
+                print("MQTT: Invalid reply topic")
 
         def stop(self):
             # Stop the MQTT susbcriber
-            # Unsubscribe from the topic
+            # Unsubscribe from the topics
             self._paho_mqtt.unsubscribe(self.topic)
+            self._paho_mqtt.unsubscribe(self.queryTopic)
             self._paho_mqtt.loop_stop()
             self._paho_mqtt.disconnect()
             print("Shutting down mqtt...")
 
+        def publish(self, topic: str, payload: str, retain: bool):
+            self._paho_mqtt.publish(topic, payload, 1, retain)
+
+    # Thread that adds the devices registered via mqtt to the catalog.
+    # The registrations are queued by the mqtt client, and processed in batches of at most batchSize: only the last
+    # registration of each device in a batch is kept, and all of them are added to the catalog at once.
+    # At most maxQueued registrations can wait: further ones are dropped (devices register again periodically anyway).
+    class RegistrationWorkerRunner(threading.Thread, cherrypy.process.plugins.SimplePlugin):
+        def __init__(self, catalog, bus, maxQueued: int, batchSize: int):
+            threading.Thread.__init__(self)
+            cherrypy.process.plugins.SimplePlugin.__init__(self, bus)
+
+            self.catalog = catalog
+            self.batchSize = batchSize
+            self.queue = queue.Queue(maxQueued)
+
+            self.running = True
+
+        def enqueue(self, payload: bytes):
+            try:
+                self.queue.put_nowait(payload)
+            except queue.Full:
+                print("MQTT: Too many registrations, dropping one")
+
+        def run(self):
+            while self.running:
+                # Don't wait too long, to be ready to shutdown
+                try:
+                    batch = [self.queue.get(timeout = 1)]
+                except queue.Empty:
+                    continue
+
+                # Take whatever else has arrived in the meantime
+                while len(batch) < self.batchSize:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                self.process(batch)
+
+        def process(self, batch: List[bytes]):
+            # Last (payload, device) of each device ID: device is None if payload is the same as the current registration
+            # of the device, which doesn't need to be parsed. Only the last registration of each device counts, so which
+            # ones are just heartbeats is decided once they're known
+            latest = {}
+            parsed = {}
+
+            for payload in batch:
+                deviceID = self.catalog.registeredID("devices", payload)
+                d = None
+
+                if deviceID is None:
+                    # The same payload only needs to be parsed once
+                    if payload not in parsed:
+                        parsed[payload] = self.parse(payload)
+                    d = parsed[payload]
+
+                    if d is None:
+                        continue
+                    deviceID = d.deviceID
+
+                latest.pop(deviceID, None)
+                latest[deviceID] = (payload, d)
+
+            devices = {}
+
+            for deviceID, (payload, d) in latest.items():
+                # Same registration as the last time: just restart the timeout
+                if d is None and self.catalog.touch("devices", deviceID):
+                    continue
+
+                # The device may have expired in the meantime
+                if d is None:
+                    d = self.parse(payload)
+                    if d is None:
+                        continue
+
+                devices[deviceID] = (d, payload)
+
+            if len(devices) == 0:
+                return
+
+            # Now insert the newly created devices into the database
+            self.catalog.registerMany("devices", [(deviceID, d) for deviceID, (d, _) in devices.items()], [payload for d, payload in devices.values()])
+
+            print("MQTT: " + str(len(devices)) + " device(s) added/updated successfully")
+
+        # Returns the device registered with payload, or None if it's not valid
+        def parse(self, payload: bytes):
+            try:
+                return Device.parseDevice(json.loads(payload))
+            except ValueError as e:
+                print("MQTT: Invalid registration: " + str(e))
+            except TypeError:
+                print("MQTT: Invalid registration")
+
+            return None
+
+        # To be called when cherrypy stops to stop the thread
+        def stop(self):
+            self.running = False
+
+    # Thread that publishes every device and service on its own topic (baseTopic/devices/<deviceID> or
+    # baseTopic/services/<serviceID>) as a retained message whenever it is added or updated, and publishes an
+    # empty retained message when it is removed: subscribing to baseTopic/# gives the current catalog, and then its changes.
+    # The changes are taken from the versions of the catalog, so that writers never wait for the broker.
+    class CatalogEventPublisherRunner(threading.Thread, cherrypy.process.plugins.SimplePlugin):
+        COLLECTIONS = ("devices", "services")
+
+        def __init__(self, catalog, bus, mqttClient, baseTopic: str):
+            threading.Thread.__init__(self)
+            cherrypy.process.plugins.SimplePlugin.__init__(self, bus)
+
+            self.catalog = catalog
+            self.mqttClient = mqttClient
+            self.baseTopic = baseTopic
+
+            # (collection, entityID) of the entities with a retained message
+            self.published = set()
+
+            self.running = True
+
+        def run(self):
+            since = None
+
+            while self.running:
+                # Publish the whole catalog at startup, or when too many changes have been missed
+                if since is None:
+                    since = self.publishAll()
+                    continue
+
+                # Don't wait too long, to be ready to shutdown
+                if not self.catalog.store.waitForChange(since, 1):
+                    continue
+
+                try:
+                    since, changes = self.catalog.store.changesSince(since)
+                except ValueError:
+                    since = None
+                    continue
+
+                for collection, entityID, entityJSON in changes:
+                    if collection in self.COLLECTIONS:
+                        self.publish(collection, entityID, entityJSON)
+
+        # Publishes all the devices and services, and clears the messages of the ones that don't exist anymore.
+        # Returns the version of the catalog they've been published at
+        def publishAll(self) -> int:
+            # Changes made while publishing are published again later
+            version = self.catalog.store.version
+            current = set()
+
+            for collection in self.COLLECTIONS:
+                entities, _ = self.catalog.store.page(collection)
+
+                for entity, entityJSON in entities:
+                    entityID = entity.deviceID if collection == "devices" else entity.serviceID
+                    current.add((collection, entityID))
+                    self.publish(collection, entityID, entityJSON)
+
+            for collection, entityID in self.published - current:
+                self.publish(collection, entityID, None)
+
+            return version
+
+        # Publishes the JSON of an entity, or clears its message if entityJSON is None
+        def publish(self, collection: str, entityID: str, entityJSON: str):
+            try:
+                self.mqttClient.publish(self.baseTopic + "/" + collection + "/" + entityID, entityJSON if entityJSON is not None else "", True)
+            except ValueError:
+                # The ID can't be part of a topic (e.g. it contains a wildcard)
+                return
+
+            if entityJSON is not None:
+                self.published.add((collection, entityID))
+            else:
+                self.published.discard((collection, entityID))
+
+        # To be called when cherrypy stops to stop the thread
+        def stop(self):
+            self.running = False
+
     # Used to initialize the attributes
     def __init__(self):
         # Initialize the database
@@ -150,32 +382,54 @@ class RESTCatalog:
         self.database["MQTTGlobalMessageBrokerURL"] = "test.mosquitto.org"
         self.database["MQTTGlobalMessageBrokerPort"] = 1883 # Default MQTT port
 
-        self.database["devices"]  = {}
-        self.database["users"]    = {}
-        self.database["services"] = {}
-
         # Initialize some commonly used jsons for responses
         self.responseSuccess = { "result": "success" }
         self.responseSuccessJSON = json.dumps(self.responseSuccess)
-        self.responseFailure = { "result": "failure", "reason": "" }
 
+        # The catalog is stored as a snapshot (the json file) plus a journal of the changes made after it
         self.JSONFile = "catalog.json"
+        self.journal = CatalogJournal(self.JSONFile, "catalog.journal")
+
+        # Devices, services and users are accessed concurrently by the cherrypy threads, the timeout manager
+        # and the mqtt client, so they are kept in a thread-safe store, which also records the changes in the journal
+        self.store = CatalogStore(self.journal)
 
-        # Initialize the json file
-        self.serializeCatalogToJSONFile()
+        # Digest of the body of the last registration of each device and service, to recognize heartbeats:
+        # (collection, digest) -> entityID and (collection, entityID) -> digest
+        self.registrations = {}
+        self.registrationDigests = {}
+        self.registrationsLock = threading.Lock()
 
-        # Initialize the thread
-        self.timeoutManagerRunner = RESTCatalog.TimeoutManagerRunner(self, cherrypy.engine, 120, 60)
+        # Slots of the watch requests being served
+        self.watchSlots = threading.BoundedSemaphore(self.watchMaxClients)
+
+        # Initialize the thread, before restoring the catalog so that the restored devices and services are scheduled for removal
+        self.timeoutManagerRunner = RESTCatalog.TimeoutManagerRunner(self, cherrypy.engine, 120)
         self.timeoutManagerRunner.subscribe() # To be notified from cherrypy
         #self.timeoutManagerRunner.start()    # cherrypy calls the start() of its plugins, which happens to be the same method to start threads
 
+        # Restore the catalog as it was before the last shutdown
+        self.loadCatalog()
+
+        # Changes are written to disk in the background, at most once per second
+        self.persister = CatalogPersister(cherrypy.engine, self.journal, self.compactCatalog, 1)
+        self.persister.subscribe() # This also starts the thread
+
+        # Initialize the thread processing the registrations received via mqtt, before they can arrive
+        self.registrationWorkerRunner = RESTCatalog.RegistrationWorkerRunner(self, cherrypy.engine, 10000, 1000)
+        self.registrationWorkerRunner.subscribe() # This also starts the thread
+
         # Initialize the MQTT subscriber client
         self.mqttDeviceSubscriber = RESTCatalog.MQTTDeviceSubscriptionListener(self.database["MQTTGlobalMessageBrokerURL"],
-            self.database["MQTTGlobalMessageBrokerPort"], "tiot19CatalogSubscriber", "/tiot/19/catalog/addDevice", self)
+            self.database["MQTTGlobalMessageBrokerPort"], "tiot19CatalogSubscriber", "/tiot/19/catalog/addDevice", "/tiot/19/catalog/query", self)
 
         # Register the MQTT subscriber client to the thread to be notified of shutdown, too
         self.timeoutManagerRunner.mqttSubscriber = self.mqttDeviceSubscriber
 
+        # Publish the changes of the catalog over mqtt, too
+        self.catalogEventPublisherRunner = RESTCatalog.CatalogEventPublisherRunner(self, cherrypy.engine, self.mqttDeviceSubscriber, "/tiot/19/catalog")
+        self.catalogEventPublisherRunner.subscribe() # This also starts the thread
+
     # Custom serializer for json.dumps(...)
     def customSerializer(self, obj):
         if isinstance(obj, (Service, User, Device)):
@@ -183,22 +437,320 @@ class RESTCatalog:
 
         raise TypeError("Type is not serializable")
 
-    def serializeCatalogToJSONFile(self):
-        # Open the file for switing
+    # Requests are served concurrently, so every failure response gets its own json
+    def failureJSON(self, reason: str) -> str:
+        return json.dumps({ "result": "failure", "reason": reason })
+
+    def captureCatalog(self):
+        return self.store.captureJSON(self.database)
+
+    # Writes a new snapshot of the catalog and empties the journal. Changes are blocked only while it's copied
+    def compactCatalog(self):
+        self.journal.compact(self.captureCatalog, self.store.lockAll)
+
+    # Rebuilds the catalog from the json file, and replays the changes recorded in the journal after it
+    def loadCatalog(self):
+        snapshot, records = self.journal.load()
+
+        if snapshot is not None:
+            for collection in ("devices", "services", "users"):
+                for entityDesc in snapshot.get(collection, {}).values():
+                    self.restoreEntity(collection, entityDesc)
+
+        for record in records:
+            try:
+                if record["op"] == "upsert":
+                    self.restoreEntity(record["collection"], record["entity"])
+                elif record["op"] == "remove":
+                    self.store.remove(record["collection"], record["id"])
+            except (KeyError, TypeError):
+                print("WARNING: Skipping invalid journal record")
+
+        # Start over with a fresh snapshot
+        self.compactCatalog()
+
+    # Adds or updates a device or a service, which is removed if it doesn't register again before the timeout.
+    # body is the json it was parsed from, if any, so that the same registration is recognized next time
+    def register(self, collection: str, entityID: str, entity, body: bytes = None):
+        entity.timestamp = str(datetime.datetime.now())
+
+        # The stored entity is a different one if only the timestamp changed
+        entity = self.store.upsert(collection, entityID, entity)
+        self.timeoutManagerRunner.schedule(collection, entityID, entity)
+
+        self.rememberRegistration(collection, entityID, body)
+
+    # Adds or updates many devices or services, given as (entityID, entity) pairs, at once.
+    # bodies are the jsons they were parsed from, if any, in the same order
+    def registerMany(self, collection: str, entities: List[tuple], bodies: List[bytes] = None):
+        timestamp = str(datetime.datetime.now())
+        for _, entity in entities:
+            entity.timestamp = timestamp
+
+        # The stored entities are different ones for those where only the timestamp changed
+        stored = self.store.upsertMany(collection, entities)
+
+        for i, ((entityID, _), entity) in enumerate(zip(entities, stored)):
+            self.timeoutManagerRunner.schedule(collection, entityID, entity)
+            self.rememberRegistration(collection, entityID, bodies[i] if bodies is not None else None)
+
+    def rememberRegistration(self, collection: str, entityID: str, body: bytes):
+        self.forgetRegistration(collection, entityID)
+
+        if body is not None:
+            digest = hashlib.blake2b(body, digest_size = 16).digest()
+
+            with self.registrationsLock:
+                self.registrations[(collection, digest)] = entityID
+                self.registrationDigests[(collection, entityID)] = digest
+
+    def forgetRegistration(self, collection: str, entityID: str):
+        with self.registrationsLock:
+            digest = self.registrationDigests.pop((collection, entityID), None)
+
+            if digest is not None:
+                self.registrations.pop((collection, digest), None)
+
+    # Devices and services register again periodically with the same json: in that case there's no need to parse it,
+    # the timeout is just restarted. Returns whether body is the same as the last registration of a device or service.
+    def refreshRegistration(self, collection: str, body: bytes) -> bool:
+        entityID = self.registeredID(collection, body)
+
+        return entityID is not None and self.touch(collection, entityID)
+
+    # Returns the ID of the device or service whose last registration is body, if any
+    def registeredID(self, collection: str, body: bytes) -> str:
+        return self.registrations.get((collection, hashlib.blake2b(body, digest_size = 16).digest()))
+
+    # Restarts the timeout of a device or a service. Returns False if there's no such entity
+    def touch(self, collection: str, entityID: str) -> bool:
+        entity = self.store.touch(collection, entityID, str(datetime.datetime.now()))
+
+        if entity is None:
+            return False
+
+        self.timeoutManagerRunner.schedule(collection, entityID, entity)
+        return True
+
+    # Parses a serialized device, service or user and puts it into the database
+    def restoreEntity(self, collection: str, entityDesc: dict):
         try:
-            jsonFile = open(self.JSONFile, "w")
-        except:
-            # Could not open the file -> log the error
-            print("ERROR: Couldn't open the file " + self.JSONFile + " for writing")
+            if collection == "devices":
+                entity = Device.parseDevice(entityDesc)
+                entityID = entity.deviceID
+            elif collection == "services":
+                entity = Service.parseService(entityDesc)
+                entityID = entity.serviceID
+            elif collection == "users":
+                entity = User.parseUser(entityDesc)
+                entityID = entity.userID
+            else:
+                raise ValueError("Unknown collection " + str(collection))
+        except ValueError as e:
+            print("WARNING: Skipping invalid entity: " + str(e))
             return
 
-        try:
-            jsonFile.write(json.dumps(self.database, default=self.customSerializer))
-        except:
-            # The database is somehow invalid or the file can't be written
-            pass
+        # Keep the original timestamp, so that the entity expires as it would have
+        age = 0
+        if collection != "users":
+            entity.timestamp = entityDesc.get("timestamp", str(datetime.datetime.now()))
+
+            try:
+                age = (datetime.datetime.now() - datetime.datetime.strptime(entity.timestamp, "%Y-%m-%d %H:%M:%S.%f")).total_seconds()
+            except ValueError:
+                pass
+
+        # The stored entity is a different one if only the timestamp changed (e.g. touches replayed from the journal)
+        entity = self.store.upsert(collection, entityID, entity)
+
+        if collection != "users":
+            self.timeoutManagerRunner.schedule(collection, entityID, entity, age)
+
+    # Returns the devices or services (only their ID and the end points) with end points matching all the filters.
+    # If entityID is specified, only that entity is considered.
+    def findEndPoints(self, collection: str, idField: str, filters: dict, entityID: str = None) -> List[dict]:
+        matches = self.store.find(collection, list(filters.items()), entityID)
+        results = []
+
+        for entity, positions in matches:
+            endPoints = entity.endPoints if positions is None else [entity.endPoints[i] for i in sorted(positions)]
+            results.append({idField: getattr(entity, idField), "endPoints": [e.serializeEndPoint() for e in endPoints]})
+
+        return results
+
+    # Removes the pagination and projection parameters from params, and returns them as (limit, cursor, fields):
+    #   limit:  maximum number of entities to return
+    #   cursor: only return the entities following this ID (the "nextCursor" of the previous page)
+    #   fields: comma separated fields of the entities to return
+    # Raises ValueError if they are not valid
+    @staticmethod
+    def parsePageParams(params: dict) -> tuple:
+        limit = params.pop("limit", None)
+        cursor = params.pop("cursor", None)
+        fields = params.pop("fields", None)
+
+        if limit is not None:
+            if not limit.isdigit() or int(limit) == 0:
+                raise ValueError("Invalid limit")
+            limit = int(limit)
+
+        if fields is not None:
+            fields = [f for f in fields.split(",") if f != ""]
+
+        return limit, cursor, fields
+
+    # Returns the JSON of the devices, services or users matching the filters, one page at a time if limit or cursor
+    # is specified (as {collection: [...], "nextCursor": ...}), and possibly only some of their fields
+    def listEntities(self, collection: str, idField: str, filters: dict, limit: int, cursor: str, fields: List[str]) -> str:
+        # The whole collection, as it is
+        if len(filters) == 0 and limit is None and cursor is None and fields is None:
+            return self.store.snapshotJSON(collection)
+
+        if len(filters) > 0:
+            matches = sorted(self.findEndPoints(collection, idField, filters), key = lambda e: e[idField])
+            if cursor is not None:
+                matches = [e for e in matches if e[idField] > cursor]
 
-        jsonFile.close()
+            page = matches if limit is None else matches[:limit]
+            nextCursor = page[-1][idField] if len(page) < len(matches) else None
+
+            fragments = [json.dumps(e if fields is None else {f: e[f] for f in fields if f in e}) for e in page]
+        else:
+            page, nextCursor = self.store.page(collection, cursor, limit)
+
+            if fields is None:
+                fragments = [fragment for _, fragment in page]
+            else:
+                fragments = []
+                for entity, _ in page:
+                    entityDesc = entity.serialize()
+                    fragments.append(json.dumps({f: entityDesc[f] for f in fields if f in entityDesc}))
+
+        entities = "[" + ", ".join(fragments) + "]"
+
+        if limit is None and cursor is None:
+            return entities
+
+        return "{" + json.dumps(collection) + ": " + entities + ', "nextCursor": ' + json.dumps(nextCursor) + "}"
+
+    # Sets the ETag of a list of entities of the collection (and the current version of the catalog, to ask for
+    # the changes made after it). Returns whether the client already has that list, so nothing has to be sent.
+    # The ETag is weak: refreshing the timestamps (touch() and unchanged registrations) is not a change, so the
+    # list may differ in the timestamps only, and If-None-Match is compared weakly as well.
+    def notModified(self, collection: str) -> bool:
+        etag = '"' + collection + "-" + str(self.store.collectionVersions[collection]) + '"'
+        cherrypy.response.headers["ETag"] = "W/" + etag
+        cherrypy.response.headers["X-Catalog-Version"] = str(self.store.version)
+
+        clientETags = [e.strip() for e in cherrypy.request.headers.get("If-None-Match", "").split(",")]
+
+        if "*" in clientETags or any((e[2:] if e.startswith("W/") else e) == etag for e in clientETags):
+            cherrypy.response.status = 304 # Not Modified
+            return True
+
+        return False
+
+    # Returns the current version and the JSON of the changes made after version since, as returned by getChanges.
+    # Raises ValueError if since is too old.
+    def changesJSON(self, since: int) -> Tuple[int, str]:
+        version, changes = self.store.changesSince(since)
+
+        records = []
+        for collection, entityID, entityJSON in changes:
+            if entityJSON is not None:
+                records.append('{"op": "upsert", "collection": ' + json.dumps(collection) + ', "entity": ' + entityJSON + "}")
+            else:
+                records.append(json.dumps({"op": "remove", "collection": collection, "id": entityID}))
+
+        return version, '{"version": ' + str(version) + ', "changes": [' + ", ".join(records) + "]}"
+
+    # Streams the changes after version since as Server-Sent Events, one event (with the version as id) per batch,
+    # until the client disconnects, cherrypy stops or watchStreamDuration seconds have passed
+    def streamChanges(self, since: int):
+        end = time.monotonic() + self.watchStreamDuration
+
+        while cherrypy.engine.state == cherrypy.engine.states.STARTED and time.monotonic() < end:
+            if not self.store.waitForChange(since, min(self.watchKeepAliveInterval, max(end - time.monotonic(), 0))):
+                # Keep the connection alive
+                yield ": keep-alive\n\n"
+                continue
+
+            try:
+                since, changesJSON = self.changesJSON(since)
+            except ValueError:
+                # The client is too slow: tell it to reload the catalog
+                yield "event: reset\ndata: {}\n\n"
+                return
+
+            yield "id: " + str(since) + "\nevent: changes\ndata: " + changesJSON + "\n\n"
+
+    # Queries that return a single entity (or few data) and are served both via HTTP and via mqtt.
+    # Returns the HTTP status and the JSON of the response
+    QUERIES = ("getMQTTMessageBroker", "getUser", "getDevice", "getService", "resolve")
+
+    def query(self, name: str, params: dict) -> Tuple[int, str]:
+        if name == "getMQTTMessageBroker":
+            if len(params) != 0:
+                return 404, self.failureJSON("Too many parameters")
+            
+            return 200, json.dumps({"url": self.database["MQTTGlobalMessageBrokerURL"], "port": self.database["MQTTGlobalMessageBrokerPort"]})
+
+        if name == "getUser":
+            if len(params) != 1 or "id" not in params:
+                return 404, self.failureJSON("Wrong parameters")
+        
+            userID = params.get("id")
+            entityJSON = self.store.getJSON("users", userID)
+            if entityJSON is not None:
+                return 200, entityJSON
+
+            return 404, self.failureJSON("No such user")
+       
+        if name == "getDevice":
+            if len(params) != 1 or "id" not in params:
+                return 404, self.failureJSON("Wrong parameters")
+        
+            deviceID = params.get("id")
+            entityJSON = self.store.getJSON("devices", deviceID)
+            if entityJSON is not None:
+                return 200, entityJSON
+
+            return 404, self.failureJSON("No such device")
+       
+        if name == "getService":
+            if len(params) != 1 or "id" not in params:
+                return 404, self.failureJSON("Wrong parameters")
+        
+            serviceID = params.get("id")
+            entityJSON = self.store.getJSON("services", serviceID)
+            if entityJSON is not None:
+                return 200, entityJSON
+        
+            return 404, self.failureJSON("No such service")
+       
+        # Returns the end points of a device or a service matching the filters, e.g. resolve?device=Yun&resource=temperature
+        if name == "resolve":
+            filters = dict(params)
+
+            if "device" in filters:
+                collection, idField, allowed, notFound = "devices", "deviceID", RESTCatalog.DEVICE_FILTERS, "No such device"
+                entityID = filters.pop("device")
+            elif "service" in filters:
+                collection, idField, allowed, notFound = "services", "serviceID", RESTCatalog.SERVICE_FILTERS, "No such service"
+                entityID = filters.pop("service")
+            else:
+                entityID = None
+
+            if entityID is None or any(p not in allowed for p in filters):
+                return 404, self.failureJSON("Wrong parameters")
+
+            if self.store.get(collection, entityID) is None:
+                return 404, self.failureJSON(notFound)
+
+            matches = self.findEndPoints(collection, idField, filters, entityID)
+            return 200, json.dumps(matches[0]["endPoints"] if len(matches) > 0 else [])
+
+        return 404, self.failureJSON("Not Found")
 
     def GET(self, *uri, **params):
         # Used to shutdown the service for debugging purposes
@@ -209,100 +761,144 @@ class RESTCatalog:
         # No service has a uri with length other than 1
         if len(uri) != 1:
             cherrypy.response.status = 404 # Not Found
-            self.responseFailure["reason"] = "Not Found"
-            return json.dumps(self.responseFailure)
+            return self.failureJSON("Not Found")
 
-        if uri[0] == "getMQTTMessageBroker":
-            if len(params) != 0:
-                cherrypy.response.status = 404 # Bad Request
-                self.responseFailure["reason"] = "Too many parameters"
-                return json.dumps(self.responseFailure)
-                
-            return json.dumps({"url": self.database["MQTTGlobalMessageBrokerURL"], "port": self.database["MQTTGlobalMessageBrokerPort"]})
+        if uri[0] in RESTCatalog.QUERIES:
+            status, response = self.query(uri[0], params)
+            cherrypy.response.status = status
+            return response
 
-        if uri[0] == "getUser":
-            if len(params) != 1 or "id" not in params:
+        if uri[0] == "getUsers":
+            try:
+                limit, cursor, fields = RESTCatalog.parsePageParams(params)
+            except ValueError as e:
                 cherrypy.response.status = 404 # Bad Request
-                self.responseFailure["reason"] = "Wrong parameters"
-                return json.dumps(self.responseFailure)
-            
-            userID = params.get("id")
-            if userID in self.database["users"]:
-                return json.dumps(self.database["users"].get(userID), default=self.customSerializer)
+                return self.failureJSON(str(e))
 
-            # Set the HTTP status
-            cherrypy.response.status = 404 # Not Found
-            self.responseFailure["reason"] = "No such user"
-            return json.dumps(self.responseFailure)
-           
-        if uri[0] == "getUsers":
             if len(params) != 0:
                 cherrypy.response.status = 404 # Bad Request
-                self.responseFailure["reason"] = "Too many parameters"
-                return json.dumps(self.responseFailure)
+                return self.failureJSON("Too many parameters")
+
+            if self.notModified("users"):
+                return ""
             
-            return json.dumps(list(self.database["users"].values()), default=self.customSerializer)
+            return self.listEntities("users", "userID", params, limit, cursor, fields)
  
-        if uri[0] == "getDevice" and params!={}:
-            if len(params) != 1 or "id" not in params:
+        if uri[0] == "getDevices":
+            try:
+                limit, cursor, fields = RESTCatalog.parsePageParams(params)
+            except ValueError as e:
                 cherrypy.response.status = 404 # Bad Request
-                self.responseFailure["reason"] = "Wrong parameters"
-                return json.dumps(self.responseFailure)
-            
-            deviceID = params.get("id")
-            if deviceID in self.database["devices"]:
-                return json.dumps(self.database["devices"].get(deviceID), default=self.customSerializer)
+                return self.failureJSON(str(e))
 
-            # Set the HTTP status
-            cherrypy.response.status = 404 # Not Found
-            self.responseFailure["reason"] = "No such device"
-            return json.dumps(self.responseFailure)
-           
-        if uri[0] == "getDevices":
-            if len(params) != 0:
+            if any(p not in RESTCatalog.DEVICE_FILTERS for p in params):
                 cherrypy.response.status = 404 # Bad Request
-                self.responseFailure["reason"] = "Too many parameters"
-                return json.dumps(self.responseFailure)
-            
-            return json.dumps(list(self.database["devices"].values()), default=self.customSerializer)
+                return self.failureJSON("Wrong parameters")
+
+            if self.notModified("devices"):
+                return ""
+
+            # If there are filters, only the matching end points of the devices are returned
+            return self.listEntities("devices", "deviceID", params, limit, cursor, fields)
        
-        if uri[0] == "getService":
-            if len(params) != 1 or "id" not in params:
-                cherrypy.response.status = 404 # Bad Request
-                self.responseFailure["reason"] = "Wrong parameters"
-                return json.dumps(self.responseFailure)
-            
-            serviceID = params.get("id")
-            if serviceID in self.database["services"]:
-                return json.dumps(self.database["services"].get(serviceID), default=self.customSerializer)
-            
-            # Set the HTTP status
-            cherrypy.response.status = 404 # Not Found
-            self.responseFailure["reason"] = "No such service"
-            return json.dumps(self.responseFailure)
-           
         if uri[0] == "getServices":
-            if len(params) != 0:
+            try:
+                limit, cursor, fields = RESTCatalog.parsePageParams(params)
+            except ValueError as e:
                 cherrypy.response.status = 404 # Bad Request
-                self.responseFailure["reason"] = "Too many parameters"
-                return json.dumps(self.responseFailure)
-            
-            return json.dumps(list(self.database["services"].values()), default=self.customSerializer)
+                return self.failureJSON(str(e))
+
+            if any(p not in RESTCatalog.SERVICE_FILTERS for p in params):
+                cherrypy.response.status = 404 # Bad Request
+                return self.failureJSON("Wrong parameters")
+
+            if self.notModified("services"):
+                return ""
+
+            # If there are filters, only the matching end points of the services are returned
+            return self.listEntities("services", "serviceID", params, limit, cursor, fields)
+
+        # Returns the devices, services and users added, updated or removed after a version of the catalog
+        # (from the X-Catalog-Version of a list, or from the previous call), in the same format as the journal
+        if uri[0] == "getChanges":
+            if len(params) != 1 or "since" not in params or not params["since"].isdigit():
+                cherrypy.response.status = 404 # Bad Request
+                return self.failureJSON("Wrong parameters")
+
+            try:
+                return self.changesJSON(int(params["since"]))[1]
+            except ValueError:
+                # The changes are not known anymore: the client has to get the whole catalog again
+                cherrypy.response.status = 410 # Gone
+                return self.failureJSON("Version too old, reload the catalog")
+
+        # Like getChanges, but waits for the next change instead of returning nothing.
+        # Clients accepting text/event-stream get all the following changes as Server-Sent Events, instead
+        # (since can also be specified with the Last-Event-ID header, to resume after a reconnection).
+        if uri[0] == "watch":
+            since = params.get("since", cherrypy.request.headers.get("Last-Event-ID", ""))
+            timeout = params.get("timeout", str(self.watchDefaultTimeout))
+
+            if any(p not in ("since", "timeout") for p in params) or not since.isdigit() or not timeout.isdigit():
+                cherrypy.response.status = 404 # Bad Request
+                return self.failureJSON("Wrong parameters")
+
+            since = int(since)
+
+            # Check the version right away
+            try:
+                _, changesJSON = self.changesJSON(since)
+            except ValueError:
+                cherrypy.response.status = 410 # Gone
+                return self.failureJSON("Version too old, reload the catalog")
+
+            if not self.watchSlots.acquire(blocking = False):
+                cherrypy.response.status = 503 # Service Unavailable
+                cherrypy.response.headers["Retry-After"] = str(self.watchDefaultTimeout)
+                return self.failureJSON("Too many watch requests, retry later")
+
+            if "text/event-stream" in cherrypy.request.headers.get("Accept", ""):
+                cherrypy.response.headers["Content-Type"] = "text/event-stream"
+                cherrypy.response.headers["Cache-Control"] = "no-cache"
+                cherrypy.response.stream = True
+
+                # The slot is released once the response is over, whether the stream was read or not (e.g. HEAD)
+                cherrypy.request.hooks.attach("on_end_request", self.watchSlots.release)
+
+                return self.streamChanges(since)
+
+            # Long polling
+            try:
+                changed = self.store.waitForChange(since, min(int(timeout), self.watchMaxTimeout))
+            finally:
+                self.watchSlots.release()
+
+            if not changed:
+                return changesJSON
+
+            try:
+                return self.changesJSON(since)[1]
+            except ValueError:
+                cherrypy.response.status = 410 # Gone
+                return self.failureJSON("Version too old, reload the catalog")
 
         cherrypy.response.status = 404 # Not Found
-        self.responseFailure["reason"] = "Not Found"
-        return json.dumps(self.responseFailure)
+        return self.failureJSON("Not Found")
     
     def PUT(self, *uri, **params):
         # Add Service
         if len(uri) == 1 and uri[0] == "addService":
-            body = cherrypy.request.body.read()
+            rawBody = cherrypy.request.body.read()
+
+            # Same registration as the last time: just restart the timeout
+            if self.refreshRegistration("services", rawBody):
+                return self.responseSuccessJSON
+
             try:
-                body = json.loads(body)
+                body = json.loads(rawBody)
             except:
                 cherrypy.response.status = 400 # Bad Request
-                self.responseFailure["reason"] = "Invalid JSON"
-                return json.dumps(self.responseFailure)
+                return self.failureJSON("Invalid JSON")
 
             # Parse the service
             try:
@@ -310,20 +906,28 @@ class RESTCatalog:
             except ValueError as e:
                 # There was an error parsing the service's json
                 cherrypy.response.status = 400 # Bad Request
-                self.responseFailure["reason"] = str(e)
-                return json.dumps(self.responseFailure)
-
-            # Add the timestamp
-            s.timestamp = str(datetime.datetime.now())
+                return self.failureJSON(str(e))
 
             # Now insert the newly created service into the database
-            self.database["services"][s.serviceID] = s
-
-            # Save the new JSON file
-            self.serializeCatalogToJSONFile()
+            self.register("services", s.serviceID, s, rawBody)
 
             return self.responseSuccessJSON
 
+        # Heartbeat of a device or service, which only restarts its timeout
+        if len(uri) == 1 and uri[0] in ("touchDevice", "touchService"):
+            if len(params) != 1 or "id" not in params:
+                cherrypy.response.status = 400 # Bad Request
+                return self.failureJSON("Wrong parameters")
+
+            if uri[0] == "touchDevice" and self.touch("devices", params["id"]):
+                return self.responseSuccessJSON
+            if uri[0] == "touchService" and self.touch("services", params["id"]):
+                return self.responseSuccessJSON
+
+            # It has expired (or never registered): it needs to register with the complete json
+            cherrypy.response.status = 404 # Not Found
+            return self.failureJSON("No such device" if uri[0] == "touchDevice" else "No such service")
+
         # Add User
         if len(uri) == 1 and uri[0] == "addUser":
             body = cherrypy.request.body.read()
@@ -331,56 +935,85 @@ class RESTCatalog:
                 body = json.loads(body)
             except:
                 cherrypy.response.status = 400 # Bad Request
-                self.responseFailure["reason"] = "Invalid JSON"
-                return json.dumps(self.responseFailure)
+                return self.failureJSON("Invalid JSON")
 
             try:
                 u = User.parseUser(body)
             except ValueError as e:
                 cherrypy.response.status = 400 # Bad Request
-                self.responseFailure["reason"] = str(e)
-                return json.dumps(self.responseFailure)
+                return self.failureJSON(str(e))
 
             # Insert the user into the global database
-            self.database["users"][u.userID] = u
-
-            # Save the new JSON file
-            self.serializeCatalogToJSONFile()
+            self.store.upsert("users", u.userID, u)
 
             return self.responseSuccessJSON
 
+        # Add many devices or services at once, e.g. from a gateway. Each one is validated on its own,
+        # and the response is the list of the results, in the same order
+        if len(uri) == 1 and uri[0] in ("addDevices", "addServices"):
+            try:
+                body = json.loads(cherrypy.request.body.read())
+            except:
+                cherrypy.response.status = 400 # Bad Request
+                return self.failureJSON("Invalid JSON")
+
+            if not isinstance(body, list):
+                cherrypy.response.status = 400 # Bad Request
+                return self.failureJSON("Expected a list")
+
+            if uri[0] == "addDevices":
+                collection, parse, idField = "devices", Device.parseDevice, "deviceID"
+            else:
+                collection, parse, idField = "services", Service.parseService, "serviceID"
+
+            results = []
+            entities = []
+
+            for entityDesc in body:
+                try:
+                    if not isinstance(entityDesc, dict):
+                        raise ValueError("Expected an object")
+
+                    entity = parse(entityDesc)
+                except (ValueError, TypeError) as e:
+                    results.append({ "result": "failure", "reason": str(e) })
+                    continue
+
+                entities.append((getattr(entity, idField), entity))
+                results.append(self.responseSuccess)
+
+            self.registerMany(collection, entities)
+
+            return json.dumps(results)
+
         # Add Device
         if len(uri) == 1 and uri[0] == "addDevice":
-            body = cherrypy.request.body.read()
+            rawBody = cherrypy.request.body.read()
+
+            # Same registration as the last time: just restart the timeout
+            if self.refreshRegistration("devices", rawBody):
+                return self.responseSuccessJSON
+
             try:
-                body = json.loads(body)
+                body = json.loads(rawBody)
             except:
                 cherrypy.response.status = 400 # Bad Request
-                self.responseFailure["reason"] = "Bad Request: Invalid JSON"
-                return json.dumps(self.responseFailure)
+                return self.failureJSON("Bad Request: Invalid JSON")
  
             try:
                 d = Device.parseDevice(body)
             except ValueError as e:
                 cherrypy.response.status = 400 # Bad Request
-                self.responseFailure["reason"] = str(e)
-                return json.dumps(self.responseFailure)
+                return self.failureJSON(str(e))
 
-            # Add timestamp
-            d.timestamp = str(datetime.datetime.now())
- 
             # Now insert the newly created device into the database
-            self.database["devices"][d.deviceID] = d
-
-            # Save the new JSON file
-            self.serializeCatalogToJSONFile()
+            self.register("devices", d.deviceID, d, rawBody)
  
             return self.responseSuccessJSON
                 
         # The requested service does not exist
         cherrypy.response.status = 404 # Not Found
-        self.responseFailure["reason"] = "Not Found"
-        return json.dumps(self.responseFailure)
+        return self.failureJSON("Not Found")
 
 if __name__ == "__main__":
     conf = {
@@ -391,7 +1024,7 @@ if __name__ == "__main__":
     }
 
     cherrypy.tree.mount(RESTCatalog(), "/", conf)
-    cherrypy.config.update({"server.socket_host": "0.0.0.0"})
+    cherrypy.config.update({"server.socket_host": "0.0.0.0", "server.thread_pool": RESTCatalog.threadPool})
 
     cherrypy.engine.start()
     cherrypy.engine.block()
\ No newline at end of file
@@ -0,0 +1,198 @@
+from CatalogJournal import CatalogJournal
+from CatalogStore import CatalogStore
+from Device import Device
+
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+# Stress test of the CatalogStore: several threads upsert, touch and remove devices while others read them with
+# snapshot(), find(), page() and changesSince(), and the journal is flushed and compacted in the background.
+# Every read is checked while it runs; at the end the indexes and the sorted IDs are rebuilt from scratch and compared
+# with the ones of the store, and the catalog is rebuilt from the journal and compared with the store.
+# Usage: python stressCatalogStore.py [seconds] [writers] [readers]
+RESOURCES = ("temperature", "humidity", "motion", "led")
+
+class CatalogStoreStress:
+    def __init__(self, directory: str, writers: int, readers: int, deviceIDs: int = 500):
+        self.journal = CatalogJournal(os.path.join(directory, "catalog.json"), os.path.join(directory, "catalog.journal"))
+        self.store = CatalogStore(self.journal, maxChanges = 1000)
+
+        self.writers = writers
+        self.readers = readers
+        self.deviceIDs = ["device%04d" % i for i in range(deviceIDs)]
+
+        self.running = True
+        self.errors = []
+        self.operations = 0
+        self.lock = threading.Lock()
+
+    def fail(self, message: str):
+        with self.lock:
+            self.errors.append(message)
+
+    def count(self, operations: int):
+        with self.lock:
+            self.operations += operations
+
+    @staticmethod
+    def randomDevice(deviceID: str) -> Device:
+        resources = random.sample(RESOURCES, random.randint(1, len(RESOURCES)))
+        d = Device.parseDevice({
+            "deviceID": deviceID,
+            "resources": resources,
+            "endPoints": [{"service": "/tiot/19/" + deviceID + "/" + r, "type": "mqttTopic", "mqttClientType": "publisher"} for r in resources]
+        })
+        d.timestamp = str(time.time())
+
+        return d
+
+    def write(self):
+        operations = 0
+
+        while self.running:
+            deviceID = random.choice(self.deviceIDs)
+            operation = random.random()
+
+            if operation < 0.4:
+                self.store.upsert("devices", deviceID, CatalogStoreStress.randomDevice(deviceID))
+            elif operation < 0.5:
+                self.store.upsertMany("devices", [(i, CatalogStoreStress.randomDevice(i)) for i in random.sample(self.deviceIDs, 10)])
+            elif operation < 0.8:
+                self.store.touch("devices", deviceID, str(time.time()))
+            else:
+                self.store.remove("devices", deviceID)
+
+            operations += 1
+
+        self.count(operations)
+
+    def read(self):
+        operations = 0
+        since = self.store.version
+
+        while self.running:
+            operation = random.random()
+
+            if operation < 0.25:
+                snapshot = self.store.snapshot("devices")
+                if len(set(d.deviceID for d in snapshot)) != len(snapshot):
+                    self.fail("snapshot: duplicate devices")
+            elif operation < 0.5:
+                key = ("resource", random.choice(RESOURCES))
+                for d, positions in self.store.find("devices", [key]):
+                    if key not in (k for k, _ in d.indexKeys()):
+                        self.fail("find: " + d.deviceID + " doesn't match " + str(key))
+            elif operation < 0.75:
+                cursor, previous = None, None
+                while True:
+                    page, cursor = self.store.page("devices", cursor, 37)
+                    for d, fragment in page:
+                        if previous is not None and d.deviceID <= previous:
+                            self.fail("page: " + d.deviceID + " after " + previous)
+                        if json.loads(fragment)["deviceID"] != d.deviceID:
+                            self.fail("page: wrong JSON for " + d.deviceID)
+                        previous = d.deviceID
+                    if cursor is None:
+                        break
+            else:
+                try:
+                    version, changes = self.store.changesSince(since)
+                except ValueError:
+                    # Fell behind the change log, like a slow client would
+                    since = self.store.version
+                    continue
+
+                if version < since:
+                    self.fail("changesSince: version went back")
+                for collection, entityID, fragment in changes:
+                    if fragment is not None and json.loads(fragment)["deviceID"] != entityID:
+                        self.fail("changesSince: wrong JSON for " + entityID)
+                since = version
+
+            operations += 1
+
+        self.count(operations)
+
+    def persist(self):
+        while self.running:
+            self.journal.flush()
+
+            if random.random() < 0.1:
+                self.journal.compact(self.store.captureJSON, self.store.lockAll)
+
+            time.sleep(0.01)
+
+    def run(self, seconds: float):
+        threads = [threading.Thread(target = self.write) for _ in range(self.writers)]
+        threads += [threading.Thread(target = self.read) for _ in range(self.readers)]
+        threads.append(threading.Thread(target = self.persist))
+
+        for t in threads:
+            t.start()
+
+        time.sleep(seconds)
+        self.running = False
+
+        for t in threads:
+            t.join()
+
+        self.journal.flush()
+
+    def check(self):
+        entities = self.store.entities["devices"]
+
+        # Sorted IDs
+        self.store.page("devices", None, 1)
+        if self.store.sortedIDs["devices"] != sorted(entities):
+            self.fail("sortedIDs don't match the devices")
+
+        # Indexes
+        rebuilt = CatalogStore()
+        for deviceID, d in entities.items():
+            rebuilt.index("devices", deviceID, d, True)
+        if rebuilt.indexes["devices"] != self.store.indexes["devices"]:
+            self.fail("indexes don't match the devices")
+
+        # Cached JSON
+        for deviceID, d in entities.items():
+            prefix, fragment = CatalogStore.serializeEntity(d)
+            if self.store.prefixes["devices"][deviceID] != prefix or self.store.fragments["devices"][deviceID] != fragment:
+                self.fail("cached JSON of " + deviceID + " doesn't match the device")
+
+        # Journal replay
+        snapshot, records = self.journal.load()
+        replayed = dict(snapshot["devices"]) if snapshot is not None else {}
+        for record in records:
+            if record["op"] == "upsert":
+                replayed[record["entity"]["deviceID"]] = record["entity"]
+            else:
+                replayed.pop(record["id"], None)
+
+        if replayed != {deviceID: json.loads(fragment) for deviceID, fragment in self.store.fragments["devices"].items()}:
+            self.fail("replaying the journal doesn't give the devices back")
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    writers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    readers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    with tempfile.TemporaryDirectory() as directory:
+        stress = CatalogStoreStress(directory, writers, readers)
+        stress.run(seconds)
+        stress.check()
+
+    print(str(stress.operations) + " operations, " + str(len(stress.store.entities["devices"])) + " devices")
+
+    for error in stress.errors[:20]:
+        print("ERROR: " + error)
+
+    if len(stress.errors) > 0:
+        print(str(len(stress.errors)) + " error(s)")
+        exit(1)
+
+    print("OK")